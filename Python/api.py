@@ -1,5 +1,141 @@
 import datetime
 import os
 from pathlib import Path
+import time
+import traceback
+from typing import Callable, Optional, cast
+from urllib.parse import urljoin
+import numpy as np
 import requests
-# figure out how we do this without a circular import. For now, code is in ClipManager
+import metrics
+from crops import CropData
+
+# list of {"timestamp": ms since the start of the clip, "boundingBox": (x, y, w, h)}
+DetectionData = list[dict]
+
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_RETRIES = 5
+
+
+# Exposes `length` bytes of an open file from its current position. requests streams file-like bodies in small
+# blocks, so a chunk never has to be read into memory in one go
+class FileSlice():
+    def __init__(self, file, length: int) -> None:
+        self._file = file
+        self._remaining = length
+        self.len = length
+
+    def __len__(self):
+        return self.len
+
+    def read(self, size: int = -1):
+        if self._remaining <= 0:
+            return b""
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+
+class ClipsApi():
+    def __init__(self, host) -> None:
+        self.host = host
+        self.session = requests.Session()
+        self.session.verify = False
+        pass
+
+    @staticmethod
+    def detection_data(detections: np.ndarray) -> DetectionData:
+        # detections is a clip_manager.DetectionStore record array
+        timestamps = np.rint(detections["timestamp"] * 1000).astype(np.int64).tolist()
+        boxes = np.stack([detections["x"], detections["y"],
+                          detections["w"], detections["h"]], axis=1).tolist()
+        return [{"timestamp": t, "boundingBox": b} for (t, b) in zip(timestamps, boxes)]
+
+    def upload_clip(self, dateRecorded: datetime.datetime, clip_path: Path, detection_data: DetectionData,
+                    crop_data: Optional[CropData] = None, upload_id: Optional[str] = None, offset: int = 0,
+                    progress: Optional[Callable[[str, int], None]] = None):
+        # Streams the clip from disk in chunks instead of reading it all into memory. A failed chunk is retried from
+        # whatever offset the API has received, the detections and crops are only sent once the whole file has been
+        # uploaded. An upload_id from an earlier call is carried on from where it got to, progress(upload_id, offset)
+        # is called whenever the API has received more of the clip so the caller can store it.
+        size = os.path.getsize(clip_path)
+        if upload_id is not None:
+            resumed = self._get_upload_offset(
+                self.make_url(f"/clips/uploads/{upload_id}"), offset)
+            if resumed is None:
+                print(f"upload {upload_id} no longer exists, starting again")
+                upload_id = None
+            else:
+                offset = resumed
+        if upload_id is None:
+            r = self.session.post(self.make_url("/clips/uploads"))
+            r.raise_for_status()
+            upload_id = cast(str, r.json()["id"])
+            offset = 0
+            if progress is not None:
+                progress(upload_id, offset)
+        url = self.make_url(f"/clips/uploads/{upload_id}")
+        print(f"uploading clip to API from offset {offset}. Sending PUT requests to {url}")
+
+        failures = 0
+        with open(clip_path, "rb") as cf:
+            while offset < size:
+                length = min(UPLOAD_CHUNK_SIZE, size - offset)
+                cf.seek(offset)
+                try:
+                    with metrics.timed("upload_chunk"):
+                        r = self.session.put(url, data=FileSlice(cf, length), headers={
+                            "Content-Type": "application/octet-stream",
+                            "Content-Range": f"bytes {offset}-{offset + length - 1}/{size}"
+                        })
+                    metrics.increment("upload_bytes", length)
+                    # 409 means the API has a different offset to us, carry on from there
+                    if r.status_code != 409:
+                        r.raise_for_status()
+                    offset = r.json()["offset"]
+                    failures = 0
+                    if progress is not None:
+                        progress(upload_id, offset)
+                except requests.RequestException:
+                    metrics.increment("upload_chunk_failures")
+                    failures += 1
+                    if failures > UPLOAD_RETRIES:
+                        raise
+                    print(traceback.format_exc())
+                    time.sleep(min(2 ** failures, 30))
+                    resumed = self._get_upload_offset(url, offset)
+                    if resumed is None:
+                        raise Exception(
+                            f"upload {upload_id} was removed by the API")
+                    offset = resumed
+
+        r = self.session.post(f"{url}/complete", json={
+            "dateRecorded": dateRecorded.isoformat(),
+            "detections": detection_data,
+            "crops": crop_data or []
+        })
+        r.raise_for_status()
+
+    def _get_upload_offset(self, url: str, default: int) -> Optional[int]:
+        # None when the API no longer has the upload
+        try:
+            r = self.session.get(url)
+            if r.status_code == 404:
+                return None
+            r.raise_for_status()
+            return r.json()["offset"]
+        except requests.RequestException:
+            return default
+
+    def delete_upload(self, upload_id: str):
+        # the API removes uploads nobody has written to for a while, this just does it sooner
+        try:
+            self.session.delete(self.make_url(
+                f"/clips/uploads/{upload_id}")).raise_for_status()
+        except requests.RequestException:
+            print(traceback.format_exc())
+
+    def make_url(self, path):
+        return urljoin(self.host, path)
@@ -0,0 +1,121 @@
+from typing import Optional
+import cv2
+from cv2 import Mat
+import numpy as np
+
+# Background models used by morphology_solver to find what has changed in a (greyscale, blurred) frame.
+# difference() returns an 8 bit image where larger values are more likely to be foreground, update() is given the
+# final foreground mask of the same frame so that moving objects are not learnt into the background.
+
+
+# The first frame is used as the background forever
+class static_background():
+    def __init__(self) -> None:
+        self.reference_frame: Optional[Mat] = None
+
+    def reset(self, frame: Optional[Mat] = None):
+        self.reference_frame = frame.copy() if frame is not None else None
+
+    def reference(self):
+        return self.reference_frame
+
+    def difference(self, frame, dst=None):
+        if self.reference_frame is None:
+            self.reset(frame)
+        return cv2.absdiff(self.reference_frame, frame, dst=dst)
+
+    def update(self, frame, foreground):
+        pass
+
+
+# Running weighted average of every frame, so that the background follows gradual lighting changes. Pixels that
+# were found to be foreground are learnt much more slowly, so a moving object isn't smeared into the background but
+# one that stays put (a parked car, a moved chair) becomes part of it. A sudden change that covers most of the frame
+# (lights switched on) isn't motion, the background is learnt again from the current frame once it has lasted
+# relearn_frames.
+class running_average_background():
+    def __init__(self, learning_rate=0.02, foreground_learning_rate=0.005, relearn_fraction=0.5, relearn_frames=30) -> None:
+        self.learning_rate = learning_rate
+        self.foreground_learning_rate = foreground_learning_rate
+        self.relearn_fraction = relearn_fraction
+        self.relearn_frames = relearn_frames
+        self._accumulator: Optional[np.ndarray] = None
+        self._reference: Optional[np.ndarray] = None
+        self._background_mask: Optional[np.ndarray] = None
+        # consecutive frames where more than relearn_fraction of the frame was foreground
+        self._large_foreground = 0
+
+    def reset(self, frame: Optional[Mat] = None):
+        self._large_foreground = 0
+        if frame is None:
+            self._accumulator = None
+            return
+
+        self._accumulator = frame.astype(np.float32)
+        self._reference = frame.copy()
+        self._background_mask = np.empty(frame.shape[:2], np.uint8)
+
+    def reference(self):
+        return self._reference
+
+    def difference(self, frame, dst=None):
+        if self._accumulator is None or self._accumulator.shape != frame.shape:
+            self.reset(frame)
+        return cv2.absdiff(self._reference, frame, dst=dst)
+
+    def update(self, frame, foreground):
+        assert self._accumulator is not None
+        if cv2.countNonZero(foreground) > self.relearn_fraction * foreground.size:
+            self._large_foreground += 1
+            if self._large_foreground >= self.relearn_frames:
+                self.reset(frame)
+                return
+        else:
+            self._large_foreground = 0
+
+        cv2.bitwise_not(foreground, dst=self._background_mask)
+        cv2.accumulateWeighted(frame, self._accumulator,
+                               self.learning_rate, mask=self._background_mask)
+        cv2.accumulateWeighted(frame, self._accumulator,
+                               self.foreground_learning_rate, mask=foreground)
+        cv2.convertScaleAbs(self._accumulator, dst=self._reference)
+
+
+# OpenCV's Gaussian mixture (MOG2) or k-nearest neighbours (KNN) background subtractors. These update their model
+# as part of difference(), and can't exclude the foreground from the update.
+class subtractor_background():
+    def __init__(self, kind="mog2", history=500) -> None:
+        self.kind = kind
+        self.history = history
+        self.reset()
+
+    def reset(self, frame: Optional[Mat] = None):
+        if self.kind == "knn":
+            self._subtractor = cv2.createBackgroundSubtractorKNN(
+                history=self.history, detectShadows=False)
+        else:
+            self._subtractor = cv2.createBackgroundSubtractorMOG2(
+                history=self.history, detectShadows=False)
+        if frame is not None:
+            self._subtractor.apply(frame, learningRate=1)
+
+    def reference(self):
+        return self._subtractor.getBackgroundImage()
+
+    def difference(self, frame, dst=None):
+        return self._subtractor.apply(frame, fgmask=dst)
+
+    def update(self, frame, foreground):
+        pass
+
+
+BACKGROUND_MODELS = ["static", "average", "mog2", "knn"]
+
+
+def create_background_model(name: str):
+    match name:
+        case "static": return static_background()
+        case "average": return running_average_background()
+        case "mog2": return subtractor_background("mog2")
+        case "knn": return subtractor_background("knn")
+    raise Exception(f"Unknown background model {name}")
@@ -0,0 +1,256 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import time
+import cv2
+import numpy as np
+from api import ClipsApi
+from background_models import BACKGROUND_MODELS
+from bs_morphology_solver import SOLVERS, create_solver
+from capture import DETECTION_WIDTH
+import clip_manager
+import compressor
+
+# Scans recorded footage for motion without the live loop. Every file is split into segments that are solved in
+# parallel by a pool of processes, and the motion found is merged into one ordered list of events, which can also be
+# cut out into clips:
+#   python batch.py recordings/ --output events.json --clips clips/
+
+SEGMENT_DURATION = 300
+# every segment starts solving this long before its first frame, so the background model has settled by then
+WARMUP_DURATION = 10
+# regions with a smaller bounding box than this fraction of the frame are ignored, the same as capture
+MIN_RELATIVE_BOX_AREA = 1.0 / 100
+VIDEO_EXTENSIONS = [".mp4", ".avi", ".mkv", ".mov", ".m4v", ".ts"]
+
+
+class Segment():
+    def __init__(self, path: Path, start: int, end: int | None, warmup: int) -> None:
+        self.path = path
+        self.start = start
+        # None is the end of the file
+        self.end = end
+        self.warmup = warmup
+
+
+class Event():
+    def __init__(self, path: Path, fps: float, start: int, end: int, detections: np.ndarray) -> None:
+        self.path = path
+        self.fps = fps
+        # frames of the source file, end is exclusive
+        self.start = start
+        self.end = end
+        self.detections = detections
+        self.clip: Path | None = None
+
+    def to_json(self):
+        relative = self.detections.copy()
+        relative["frame_number"] -= self.start
+        relative["timestamp"] -= self.start / self.fps
+        return {
+            "file": str(self.path),
+            "start_frame": self.start,
+            "end_frame": self.end,
+            "start": self.start / self.fps,
+            "end": self.end / self.fps,
+            "clip": str(self.clip) if self.clip is not None else None,
+            "detections": ClipsApi.detection_data(relative),
+        }
+
+
+def find_videos(path: Path):
+    if path.is_dir():
+        return sorted(p for p in path.iterdir() if p.suffix.lower() in VIDEO_EXTENSIONS)
+    return [path]
+
+
+def video_info(path: Path):
+    video = cv2.VideoCapture(str(path))
+    if not video.isOpened():
+        raise Exception(f"Could not open {path}")
+    info = (int(video.get(cv2.CAP_PROP_FRAME_COUNT)),
+            video.get(cv2.CAP_PROP_FPS) or 30.0)
+    video.release()
+    return info
+
+
+def split_segments(path: Path, frame_count: int, fps: float, segment_duration: float, warmup_duration: float):
+    if frame_count <= 0:
+        # the length of some files is only known once they have been read, they are scanned in one go
+        return [Segment(path, 0, None, 0)]
+    length = max(1, int(segment_duration * fps))
+    warmup = int(warmup_duration * fps)
+    return [Segment(path, start, min(start + length, frame_count), min(start, warmup))
+            for start in range(0, frame_count, length)]
+
+
+def _init_worker():
+    # one thread per process, the pool is what makes use of the cores
+    cv2.setNumThreads(1)
+    os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = "threads;1"
+
+
+def scan_segment(segment: Segment, solver_name: str, background: str, detection_width: int) -> tuple[np.ndarray, int]:
+    # detections of every frame in the segment, in source coordinates and timestamped with their position in the
+    # video, as clip_manager.DETECTION_DTYPE records, and the number of the frame after the last one that was read
+    solver = create_solver(solver_name, background)
+    video = cv2.VideoCapture(str(segment.path))
+    first = segment.start - segment.warmup
+    if first > 0:
+        video.set(cv2.CAP_PROP_POS_FRAMES, first)
+        # seeking is only exact in some formats, frames are numbered from wherever it got to
+        first = int(video.get(cv2.CAP_PROP_POS_FRAMES))
+
+    store = clip_manager.DetectionStore()
+    detection_frame = None
+    frame_number = first - 1
+    while segment.end is None or frame_number + 1 < segment.end:
+        (ok, frame) = video.read()
+        if not ok:
+            break
+        frame_number += 1
+
+        if detection_frame is None:
+            (height, width) = frame.shape[:2]
+            detection_width = min(detection_width, width)
+            detection_size = (detection_width, int(
+                round(height * detection_width / width)))
+            resize = detection_size != (width, height)
+            detection_frame = np.empty(
+                (detection_size[1], detection_size[0], 3), np.uint8)
+            scale = width / detection_size[0]
+            min_box_area = MIN_RELATIVE_BOX_AREA * \
+                detection_size[0] * detection_size[1]
+
+        if resize:
+            cv2.resize(frame, detection_size, dst=detection_frame,
+                       interpolation=cv2.INTER_AREA)
+        else:
+            detection_frame = frame
+
+        (boxes, areas, _) = solver.solve_regions(
+            detection_frame, min_box_area)
+        if frame_number < segment.start or len(boxes) == 0:
+            continue
+        boxes = np.rint(boxes * scale).astype(int).tolist()
+        areas = (areas * scale * scale).tolist()
+        store.add(frame_number, [(tuple(b), None, a) for (b, a) in zip(boxes, areas)],
+                  video.get(cv2.CAP_PROP_POS_MSEC) / 1000)
+    video.release()
+    store.compact()
+    return (store.records, frame_number + 1)
+
+
+def merge_events(path: Path, fps: float, frame_count: int, detections: np.ndarray, pre_roll: float, post_roll: float, merge_gap: float):
+    # motion separated by no more than the post-roll and merge gap is one event, the same as the event clip mode
+    if len(detections) == 0:
+        return []
+    frames = np.unique(detections["frame_number"])
+    max_gap = int((post_roll + merge_gap) * fps)
+    breaks = np.flatnonzero(np.diff(frames) > max_gap + 1)
+    starts = frames[np.concatenate([[0], breaks + 1])]
+    ends = frames[np.concatenate([breaks, [len(frames) - 1]])]
+
+    events = []
+    for (first, last) in zip(starts.tolist(), ends.tolist()):
+        in_event = (detections["frame_number"] >= first) & (
+            detections["frame_number"] <= last)
+        events.append(Event(path, fps, max(0, first - int(pre_roll * fps)),
+                            min(frame_count, last + 1 + int(post_roll * fps)), detections[in_event]))
+    return events
+
+
+def extract_clip(event: Event, output_path: Path, profile_name: str, crf: int):
+    # re-encoded rather than stream copied, so that the clip starts on the event's first frame and not a keyframe
+    profile = compressor.PROFILES[profile_name]
+    arguments = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+                 "-ss", f"{event.start / event.fps:.3f}", "-i", str(event.path),
+                 "-frames:v", str(event.end - event.start), "-an",
+                 *profile.output_arguments(crf), str(output_path)]
+    subprocess.run(arguments, check=True)
+    return output_path
+
+
+def scan(paths: list[Path], workers: int, solver: str, background: str, detection_width: int,
+         segment_duration: float = SEGMENT_DURATION, warmup_duration: float = WARMUP_DURATION,
+         pre_roll: float = clip_manager.PRE_ROLL_DURATION, post_roll: float = clip_manager.POST_ROLL_DURATION,
+         merge_gap: float = clip_manager.MERGE_GAP_DURATION):
+    videos = [(path, *video_info(path)) for path in paths]
+    segments = [s for (path, frame_count, fps) in videos
+                for s in split_segments(path, frame_count, fps, segment_duration, warmup_duration)]
+    print(f"Scanning {len(videos)} files in {len(segments)} segments with {workers} workers")
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+        results = pool.map(scan_segment, segments, [solver] * len(segments),
+                           [background] * len(segments), [detection_width] * len(segments))
+        detections: dict[Path, list[np.ndarray]] = {path: [] for (path, _, _) in videos}
+        # CAP_PROP_FRAME_COUNT is only an estimate, the length of a file is where its last segment ended
+        frame_counts = {path: 0 for (path, _, _) in videos}
+        for (segment, (records, end)) in zip(segments, results):
+            detections[segment.path].append(records)
+            frame_counts[segment.path] = max(frame_counts[segment.path], end)
+
+    # segments come back in order, so the events of each file are already ordered
+    events: list[Event] = []
+    for (path, _, fps) in videos:
+        records = np.concatenate(detections[path])
+        events.extend(merge_events(path, fps, frame_counts[path], records,
+                      pre_roll, post_roll, merge_gap))
+    return events
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find motion in recorded video files, using every core")
+    parser.add_argument("path", type=str,
+                        help="Video file, or a directory of them")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--solver", default="fast",
+                        choices=SOLVERS)
+    parser.add_argument("--background", default="average",
+                        choices=BACKGROUND_MODELS)
+    parser.add_argument("--detection-width", type=int,
+                        default=DETECTION_WIDTH)
+    parser.add_argument("--segment", type=float, default=SEGMENT_DURATION,
+                        help="Seconds of video solved by each worker at a time")
+    parser.add_argument("--warmup", type=float, default=WARMUP_DURATION,
+                        help="Seconds before each segment that are solved to settle the background model")
+    parser.add_argument("--pre-roll", type=float,
+                        default=clip_manager.PRE_ROLL_DURATION)
+    parser.add_argument("--post-roll", type=float,
+                        default=clip_manager.POST_ROLL_DURATION)
+    parser.add_argument("--merge-gap", type=float,
+                        default=clip_manager.MERGE_GAP_DURATION)
+    parser.add_argument("--output", default="events.json",
+                        help="File the events are written to")
+    parser.add_argument("--clips", type=str,
+                        help="Cut every event out into a clip in this directory")
+    parser.add_argument("--profile", default=compressor.DEFAULT_PROFILE,
+                        choices=list(compressor.PROFILES))
+    parser.add_argument("--crf", type=int,
+                        default=compressor.map_compression_level_to_crf("m"))
+    args = parser.parse_args(sys.argv[1:])
+
+    start = time.perf_counter()
+    events = scan(find_videos(Path(args.path)), args.workers, args.solver, args.background, args.detection_width,
+                  args.segment, args.warmup, args.pre_roll, args.post_roll, args.merge_gap)
+    print(f"Found {len(events)} events in {time.perf_counter() - start:.1f}s")
+
+    if args.clips is not None:
+        clips_dir = Path(args.clips)
+        clips_dir.mkdir(parents=True, exist_ok=True)
+        with ProcessPoolExecutor(args.workers) as pool:
+            paths = [clips_dir.joinpath(f"{e.path.stem}_{e.start}.mp4")
+                     for e in events]
+            for (event, path) in zip(events, pool.map(extract_clip, events, paths,
+                                                      [args.profile] * len(events), [args.crf] * len(events))):
+                event.clip = path
+                print(f"Saved to {path}")
+
+    with open(args.output, "w") as f:
+        json.dump([e.to_json() for e in events], f, indent=2)
+    print(f"Events written to {args.output}")
@@ -0,0 +1,262 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import cv2
+import numpy as np
+from bs_morphology_solver import SOLVERS, create_solver
+import clip_manager
+import compressor
+from frame_ring import SharedFrameRing
+
+# Reproducible benchmarks of the detection and clip pipeline on synthetic video. Every case runs in its own process,
+# so that its peak RSS can be measured, and the results are written to a JSON file that can be compared between
+# commits:
+#   python benchmark.py --resolutions 640x360,1280x720 --output before.json
+
+RESOLUTIONS = "640x360,1280x720,1920x1080"
+FRAMES = 300
+FPS = 30
+SEED = 1
+
+
+def generate_video(path: Path, size: tuple[int, int], frames: int = FRAMES, fps: int = FPS, seed: int = SEED):
+    # textured background with slow lighting drift and sensor noise, and a few blobs that move across it for part
+    # of the video so that there are both still and moving sections
+    (width, height) = size
+    rng = np.random.default_rng(seed)
+    background = cv2.GaussianBlur(
+        (rng.random((height, width, 3)) * 160 + 40).astype(np.float32), (0, 0), width / 200)
+    blobs = [(rng.uniform(0.1, 0.9), rng.uniform(0.2, 0.8), rng.uniform(-0.01, 0.01), rng.uniform(-0.005, 0.005),
+              rng.uniform(0.03, 0.08), tuple(int(c) for c in rng.integers(0, 255, 3))) for _ in range(3)]
+    writer = cv2.VideoWriter(
+        str(path), cv2.VideoWriter.fourcc(*"mp4v"), fps, size)
+    frame = np.empty((height, width, 3), np.float32)
+    noise = np.empty((height, width, 3), np.float32)
+    for i in range(frames):
+        drift = 1 + 0.1 * np.sin(i / frames * 2 * np.pi)
+        np.multiply(background, drift, out=frame)
+        noise[:] = rng.normal(0, 4, (height, width, 3))
+        frame += noise
+        # blobs are only on screen for the middle half of the video
+        if frames // 4 <= i < 3 * frames // 4:
+            for (x, y, dx, dy, radius, colour) in blobs:
+                centre = (int(((x + dx * i) % 1) * width),
+                          int(((y + dy * i) % 1) * height))
+                cv2.circle(frame, centre, int(radius * width), colour, -1)
+        writer.write(np.clip(frame, 0, 255).astype(np.uint8))
+    writer.release()
+
+
+def _frames(path: Path):
+    # decoded one at a time, holding the whole video in memory would make it most of the peak RSS of a case
+    video = cv2.VideoCapture(str(path))
+    try:
+        while True:
+            (ok, frame) = video.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        video.release()
+
+
+def _latency_stats(latencies: list[float]):
+    ms = np.array(latencies) * 1000
+    total = float(np.sum(latencies))
+    return {
+        "frames": len(latencies),
+        "fps": len(latencies) / total if total > 0 else None,
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(np.max(ms)),
+    }
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return None
+    # kilobytes on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale,
+    }
+
+
+def bench_solver(video: Path, solver: str, background: str):
+    s = create_solver(solver, background)
+    latencies = []
+    for frame in _frames(video):
+        start = time.perf_counter()
+        s.solve(frame)
+        latencies.append(time.perf_counter() - start)
+    return _latency_stats(latencies)
+
+
+def _drain_frames(queue: multiprocessing.Queue, arrivals: multiprocessing.Queue):
+    # stands in for the ClipManager, releasing every frame as soon as it arrives
+    ring = None
+    times = []
+    while True:
+        message = queue.get()
+        (_, data) = message
+        if isinstance(data, bool):
+            break
+        if len(data) == 4:
+            ring = SharedFrameRing.attach(data[2])
+            continue
+        times.append(time.perf_counter())
+        ring.release(data[0])  # type: ignore
+    if ring is not None:
+        ring.close()
+    arrivals.put(times)
+
+
+def bench_capture(video: Path, detection_width: int):
+    # capture in file mode, headless and not paced, without any clips being recorded
+    from capture import capture
+    queue = multiprocessing.Queue()
+    arrivals = multiprocessing.Queue()
+    drain = multiprocessing.Process(
+        target=_drain_frames, args=(queue, arrivals))
+    drain.start()
+    start = time.perf_counter()
+    capture(cv2.VideoCapture(str(video)), queue, live=False,
+            detection_width=detection_width, headless=True)
+    elapsed = time.perf_counter() - start
+    times = arrivals.get()
+    drain.join()
+    # time between frames reaching the consumer
+    result = _latency_stats(list(np.diff(times)))
+    result["fps"] = len(times) / elapsed
+    return result
+
+
+def bench_encode(video: Path, size: tuple[int, int], encoder: str):
+    out_dir = Path(tempfile.mkdtemp())
+    settings = clip_manager.ClipSettings(
+        encoder=encoder, crf=compressor.map_compression_level_to_crf("m"))
+    latencies = []
+    try:
+        # decoding the source video is not part of the time
+        start = time.perf_counter()
+        clip = clip_manager.Clip(None, FPS, size,
+                                 out_dir.joinpath("benchmark"), settings)
+        elapsed = time.perf_counter() - start
+        for frame in _frames(video):
+            frame_start = time.perf_counter()
+            clip.append(frame, [])
+            latencies.append(time.perf_counter() - frame_start)
+        start = time.perf_counter()
+        clip.close()
+        clip.end_encoding()
+        # compresses xvid clips, then removes the clip as there is no spool
+        clip.process()
+        elapsed += sum(latencies) + time.perf_counter() - start
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    result = _latency_stats(latencies)
+    result["fps"] = len(latencies) / elapsed
+    result["seconds_per_clip_second"] = elapsed / (len(latencies) / FPS)
+    return result
+
+
+def _run_case(target, args, results: multiprocessing.Queue):
+    try:
+        result = target(*args)
+        result["peak_rss_mb"] = _peak_rss_mb()
+        results.put(result)
+    except Exception:
+        results.put({"error": traceback.format_exc()})
+
+
+def run_case(target, *args):
+    results = multiprocessing.Queue()
+    p = multiprocessing.Process(
+        target=_run_case, args=(target, args, results))
+    p.start()
+    result = results.get()
+    p.join()
+    return result
+
+
+def _environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                                text=True, cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "date": datetime.datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the detection and clip pipeline on synthetic video")
+    parser.add_argument("--resolutions", default=RESOLUTIONS,
+                        help="Comma separated list of WIDTHxHEIGHT")
+    parser.add_argument("--frames", type=int, default=FRAMES)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--benchmarks", default="solver,capture,encode",
+                        help="Comma separated list of solver, capture and encode")
+    parser.add_argument("--output", default="benchmark.json",
+                        help="File the results are written to")
+    args = parser.parse_args(sys.argv[1:])
+
+    benchmarks = args.benchmarks.split(",")
+    resolutions = [tuple(int(v) for v in r.split("x"))
+                   for r in args.resolutions.split(",")]
+    results = []
+    with tempfile.TemporaryDirectory() as video_dir:
+        for size in resolutions:
+            (width, height) = size
+            video = Path(video_dir).joinpath(f"{width}x{height}.mp4")
+            print(f"Generating {video.name}")
+            generate_video(video, size, args.frames, seed=args.seed)  # type: ignore
+
+            cases = []
+            if "solver" in benchmarks:
+                for solver in SOLVERS:
+                    for background in ["static", "average"]:
+                        cases.append(("solver", {"solver": solver, "background": background},
+                                      bench_solver, (video, solver, background)))
+            if "capture" in benchmarks:
+                cases.append(("capture", {"detection_width": 320},
+                              bench_capture, (video, 320)))
+            if "encode" in benchmarks:
+                for encoder in [clip_manager.ENCODER_PIPE, clip_manager.ENCODER_XVID]:
+                    cases.append(("encode", {"encoder": encoder},
+                                  bench_encode, (video, size, encoder)))
+
+            for (name, params, target, case_args) in cases:
+                result = run_case(target, *case_args)
+                results.append({"benchmark": name, "resolution": f"{width}x{height}",
+                                "params": params, "result": result})
+                summary = "failed" if "error" in result else f"{result['fps']:.1f} fps, p99 {result['p99_ms']:.2f}ms"
+                print(f"{name} {width}x{height} {params}: {summary}")
+
+    with open(args.output, "w") as f:
+        json.dump({"environment": _environment(),
+                  "results": results}, f, indent=2)
+    print(f"Results written to {args.output}")
@@ -1,15 +1,87 @@
-from typing import Optional
+from typing import Optional, cast
 import cv2
-from cv2 import Mat
 import numpy as np
+from background_models import create_background_model, static_background
+import metrics
+
+
+# kernel sizes below are tuned for frames of this width, and scaled for frames of other sizes
+REFERENCE_WIDTH = 1280
+
+
+def _scale_kernel_size(size: int, width: int):
+    scaled = int(round(size * width / REFERENCE_WIDTH))
+    # kernels must be odd
+    return max(3, scaled + 1 - scaled % 2)
+
+
+# below this many contours contour_boxes_and_areas calls OpenCV once per contour instead
+BATCHED_MIN_CONTOURS = 48
+
+
+def contour_boxes_and_areas(contours) -> tuple[np.ndarray, np.ndarray]:
+    # The same as cv2.boundingRect and cv2.contourArea for every contour, in a few array operations over all of
+    # the points at once instead of two calls per contour. The array operations have a fixed cost that is only
+    # worth paying once there are a lot of contours, which is when the noisiest frames spend the most time here
+    if len(contours) < BATCHED_MIN_CONTOURS:
+        boxes = np.array([cv2.boundingRect(c) for c in contours], np.int32).reshape(-1, 4)
+        areas = np.array([cv2.contourArea(c) for c in contours], np.float64)
+        return (boxes, areas)
+
+    lengths = np.fromiter((len(c) for c in contours), np.intp, len(contours))
+    starts = np.zeros(len(contours), np.intp)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    points = np.concatenate(contours).reshape(-1, 2)
+    x = points[:, 0]
+    y = points[:, 1]
+
+    min_x = np.minimum.reduceat(x, starts)
+    min_y = np.minimum.reduceat(y, starts)
+    boxes = np.stack([min_x, min_y, np.maximum.reduceat(x, starts) - min_x + 1,
+                      np.maximum.reduceat(y, starts) - min_y + 1], axis=1).astype(np.int32)
+
+    # shoelace formula, the point after the last point of a contour is its first point
+    following = np.arange(1, len(points) + 1)
+    following[starts + lengths - 1] = starts
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+    cross = x * y[following] - x[following] * y
+    areas = np.abs(np.add.reduceat(cross, starts)) / 2
+    return (boxes, areas)
 
 
 class morphology_solver():
-    def __init__(self, low_mask_thresh=10, threshold=70) -> None:
-        self.reference_frame: Optional[Mat] = None
+    def __init__(self, low_mask_thresh=10, threshold=70, background_model=None) -> None:
+        # defaults to the first frame as the background, see background_models for the alternatives
+        self.background_model = background_model if background_model is not None else static_background()
         self.mask_thresh = low_mask_thresh
         self.min_thresh = threshold
-        self._unprocessed_ref_frame = self.reference_frame
+        # pixels that are 0 in the zone mask are never foreground, see set_zone_mask
+        self.zone_mask: Optional[np.ndarray] = None
+        # width kernels are sized for, when the frames solved are cut out of a larger frame
+        self._frame_width: Optional[int] = None
+        self._configure(REFERENCE_WIDTH)
+
+    def set_zone_mask(self, mask: Optional[np.ndarray], frame_width: Optional[int] = None):
+        # mask is the size of the frames that will be solved, from zones.DetectionZones. It is applied to the
+        # difference, before thresholding, and to the foreground before contours are found. frame_width is the
+        # width of the frame the zones were cut out of, so that the kernels don't depend on the size of the zones
+        self.zone_mask = mask
+        self._frame_width = frame_width
+        self._configure(self._width)
+
+    def _apply_zone_mask(self, frame):
+        if self.zone_mask is not None:
+            cv2.bitwise_and(frame, self.zone_mask, dst=frame)
+        return frame
+
+    def _configure(self, width: int):
+        self._width = width
+        kernel_width = self._frame_width if self._frame_width is not None else width
+        blur_size = _scale_kernel_size(25, kernel_width)
+        self._blur_size = (blur_size, blur_size)
+        close_size = _scale_kernel_size(7, kernel_width)
+        self._close_kernel = np.ones((close_size, close_size), np.uint8)
 
     def _display(self, window_name: str, frame, debug=True):
         if debug:
@@ -21,8 +93,7 @@ class morphology_solver():
         return frame_processed
 
     def _blur_frame_gaussian(self, frame, debug=True):
-        kernel_size = (25, 25)
-        processed = cv2.GaussianBlur(frame, kernel_size, 0)
+        processed = cv2.GaussianBlur(frame, self._blur_size, 0)
         self._display("gaussian_blur", processed, debug)
         return processed
 
@@ -33,13 +104,14 @@ class morphology_solver():
         return processed
 
     def _preprocess(self, frame, debug=True):
-        greyscale = self._convert_to_greyscale(frame, debug)
-        blurred = self._blur_frame_median(greyscale, debug)
-        blurred2 = self._blur_frame_gaussian(greyscale, debug)
-        return blurred2
+        with metrics.timed("solve_greyscale"):
+            greyscale = self._convert_to_greyscale(frame, debug)
+        with metrics.timed("solve_blur"):
+            blurred = self._blur_frame_gaussian(greyscale, debug)
+        return blurred
 
-    def _background_subtraction(self, initial_frame, frame, debug=True):
-        processed = cv2.absdiff(initial_frame, frame)
+    def _background_subtraction(self, frame, debug=True):
+        processed = self.background_model.difference(frame)
         self._display("background subtraction", processed, debug)
         return processed
 
@@ -64,37 +136,143 @@ class morphology_solver():
 
     def _fill_and_smooth_internal_holes(self, frame, debug=True):
         morph_frame = frame
-        kernel = np.ones((7, 7), np.uint8)
         morph_frame = cv2.morphologyEx(
-            morph_frame, cv2.MORPH_CLOSE, kernel, iterations=2)
+            morph_frame, cv2.MORPH_CLOSE, self._close_kernel, iterations=2)
 
         # morph_frame = cv2.morphologyEx(
         #     morph_frame, cv2.MORPH_ERODE, kernel, iterations=10)
         self._display(f"Morph", morph_frame, debug)
         return morph_frame
 
-    def _process(self, reference_frame, frame, debug=True):
-        background_subtracted_frame = self._background_subtraction(
-            reference_frame, frame, debug)
-        masked = self._apply_mask_low(background_subtracted_frame, debug)
-        normalized = self._normalize_frame(masked, debug)
-        binary_thresholded_frame = self._apply_thresholding(normalized, debug)
-        smoothed = self._fill_and_smooth_internal_holes(
-            binary_thresholded_frame, debug)
+    def _process(self, frame, debug=True):
+        with metrics.timed("solve_background_subtraction"):
+            background_subtracted_frame = self._apply_zone_mask(
+                self._background_subtraction(frame, debug))
+        with metrics.timed("solve_threshold"):
+            masked = self._apply_mask_low(background_subtracted_frame, debug)
+            normalized = self._normalize_frame(masked, debug)
+            binary_thresholded_frame = self._apply_thresholding(
+                normalized, debug)
+        with metrics.timed("solve_close"):
+            smoothed = self._apply_zone_mask(self._fill_and_smooth_internal_holes(
+                binary_thresholded_frame, debug))
         return smoothed
 
-    def solve(self, current_frame, debug=True):
+    def foreground_mask(self, current_frame, debug=False):
+        if current_frame.shape[1] != self._width:
+            self._configure(current_frame.shape[1])
         preprocessed = self._preprocess(current_frame, debug=debug)
 
-        if self.reference_frame is None:
-            self._unprocessed_ref_frame = current_frame
-            self.reference_frame = preprocessed
-
-        self._display("Reference frame", self._unprocessed_ref_frame, debug)
-        foreground = self._process(self.reference_frame, preprocessed, debug)
+        foreground = self._process(preprocessed, debug)
+        with metrics.timed("solve_background_update"):
+            self.background_model.update(preprocessed, foreground)
+        self._display("Reference frame",
+                      self.background_model.reference(), debug)
         self._display("Final Foregound", foreground, debug)
-        return cv2.findContours(foreground,
-                                cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        return foreground
+
+    def solve(self, current_frame, debug=False):
+        foreground = self.foreground_mask(current_frame, debug)
+        with metrics.timed("solve_find_contours"):
+            return cv2.findContours(foreground,
+                                    cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    def solve_regions(self, current_frame, min_box_area=0, debug=False):
+        # Boxes (x, y, w, h) and areas of the outer contours, as arrays, along with the index of each contour.
+        # Contours with a bounding box smaller than min_box_area are dropped. region_contour() gives the contour of
+        # a region, for as long as no other frame has been solved.
+        (self._contours, _) = self.solve(current_frame, debug)
+        with metrics.timed("solve_regions"):
+            (boxes, areas) = contour_boxes_and_areas(self._contours)
+            indices = np.flatnonzero(boxes[:, 2] * boxes[:, 3] >= min_box_area)
+            return (boxes[indices], areas[indices], indices)
+
+    def region_contour(self, index: int) -> np.ndarray:
+        return self._contours[index]
 
     def update_reference_frame(self, frame):
-        self.reference_frame = frame
+        # frame must already be preprocessed (greyscale and blurred)
+        self.background_model.reset(frame)
+
+
+# Produces the same contours as morphology_solver without allocating anything per frame. Every step writes into
+# buffers allocated for the first frame, and the mask, normalize and threshold steps are combined into a single
+# lookup table that is rebuilt from the min/max of each difference frame.
+class fast_morphology_solver(morphology_solver):
+    def __init__(self, low_mask_thresh=10, threshold=70, background_model=None) -> None:
+        super().__init__(low_mask_thresh, threshold, background_model)
+        self._shape: Optional[tuple[int, int]] = None
+        self._lut = np.zeros(256, np.uint8)
+        self._lut_values = np.arange(256, dtype=np.float64)
+        self._lut_values[:self.mask_thresh] = 0
+
+    def _allocate(self, shape: tuple[int, int]):
+        self._shape = shape
+        self._configure(shape[1])
+        self._greyscale = np.empty(shape, np.uint8)
+        self._blurred = np.empty(shape, np.uint8)
+        self._difference = np.empty(shape, np.uint8)
+        self._thresholded = np.empty(shape, np.uint8)
+        self._foreground = np.empty(shape, np.uint8)
+        self.background_model.reset()
+
+    def _update_lut(self, difference):
+        # pixels below mask_thresh are zeroed by the mask, which changes the min/max seen by the normalize
+        (min_value, max_value, _, _) = cv2.minMaxLoc(difference)
+        if min_value < self.mask_thresh:
+            min_value = 0
+        if max_value < self.mask_thresh:
+            max_value = 0
+
+        # same scale and shift as cv2.normalize with NORM_MINMAX
+        scale = 255 / (max_value -
+                       min_value) if max_value - min_value > 0 else 0
+        shift = -min_value * scale
+        normalized = np.rint(self._lut_values * scale + shift)
+        np.copyto(self._lut, 0)
+        self._lut[normalized > self.min_thresh] = 255
+
+    def foreground_mask(self, current_frame, debug=False):
+        shape = cast(tuple[int, int], current_frame.shape[:2])
+        if self._shape != shape:
+            self._allocate(shape)
+
+        with metrics.timed("solve_greyscale"):
+            cv2.cvtColor(current_frame, cv2.COLOR_BGR2GRAY,
+                         dst=self._greyscale)
+        with metrics.timed("solve_blur"):
+            # GaussianBlur is already applied as two 1D passes, and unlike a float sepFilter2D it matches the
+            # reference solver bit for bit
+            cv2.GaussianBlur(self._greyscale, self._blur_size,
+                             0, dst=self._blurred)
+        with metrics.timed("solve_background_subtraction"):
+            self.background_model.difference(
+                self._blurred, dst=self._difference)
+            self._apply_zone_mask(self._difference)
+        with metrics.timed("solve_threshold"):
+            self._update_lut(self._difference)
+            cv2.LUT(self._difference, self._lut, dst=self._thresholded)
+        with metrics.timed("solve_close"):
+            cv2.morphologyEx(self._thresholded, cv2.MORPH_CLOSE,
+                             self._close_kernel, dst=self._foreground, iterations=2)
+            self._apply_zone_mask(self._foreground)
+        with metrics.timed("solve_background_update"):
+            self.background_model.update(self._blurred, self._foreground)
+
+        self._display("gaussian_blur", self._blurred, debug)
+        self._display("background subtraction", self._difference, debug)
+        self._display("threshold frame", self._thresholded, debug)
+        self._display("Final Foregound", self._foreground, debug)
+        return self._foreground
+
+
+SOLVERS = ["fast", "reference"]
+
+
+def create_solver(name: str, background: str):
+    # background is one of background_models.BACKGROUND_MODELS
+    model = create_background_model(background)
+    match name:
+        case "fast": return fast_morphology_solver(background_model=model)
+        case "reference": return morphology_solver(background_model=model)
+    raise Exception(f"Unknown solver {name}")
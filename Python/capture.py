@@ -4,14 +4,22 @@ import os
 from pathlib import Path
 import time
 import traceback
-from typing import cast
-from bs_morphology_solver import morphology_solver
+from typing import Optional
+from background_models import running_average_background
+from bs_morphology_solver import fast_morphology_solver, morphology_solver
 import cv2
 from cv2 import CAP_PROP_FRAME_HEIGHT
 from cv2 import VideoCapture
-from cv2 import CAP_PROP_POS_FRAMES
 from cv2 import Mat
+import numpy as np
 import clip_manager
+import debug_viewer
+from frame_reader import READ_ALL, READ_LATEST, FrameReader
+from fps_estimator import FpsEstimator
+from frame_ring import SharedFrameRing
+import metrics
+from motion_gate import MotionGate
+from zones import DetectionZones
 
 
 def display(window_name, frame, show_frame=True):
@@ -24,44 +32,38 @@ def get_output_size(capture: VideoCapture):  # type: ignore
             int(capture.get(CAP_PROP_FRAME_HEIGHT)))
 
 
-def get_predicted_fps(capture: VideoCapture):  # type: ignore
-    file_fps = capture.get(cv2.CAP_PROP_FPS)
-    if file_fps != 0:
-        return file_fps
-
-    NUMBER_OF_FRAMES = 360
-    start = time.time()
-    for i in range(0, NUMBER_OF_FRAMES):
-        capture.read()
-    seconds = time.time() - start
-    capture.set(CAP_PROP_POS_FRAMES, 0)
-    return NUMBER_OF_FRAMES / seconds
-
-
 def is_key(input, key):
     return input & 0xFF == ord(key)
 
 
 RUN_AT_FRAMERATE = False
-solver = morphology_solver()
-
+FRAME_RING_SLOTS = 16
+# motion detection runs on a much smaller copy of the frame, clips are still recorded at the processing size
+DETECTION_WIDTH = 320
+# id used when there is only one camera
+DEFAULT_CAMERA = ""
+
+
+# Every message sent to the ClipManager is tagged with camera_id, so that many cameras can share one ClipManager.
+# The loop ends when the video ends, q is pressed or the stop event is set. Headless captures never use HighGUI,
+# debug_viewer.py can be used to watch them instead. With a motion gate the solver is skipped for frames where
+# nothing has changed, and those frames are treated as having no motion. Only bounding boxes are sent with each
+# frame unless with_contours is set. With zones only their bounding box is solved, and motion outside of them is masked
+# out before thresholding.
+def capture(capture: VideoCapture, queue: multiprocessing.Queue, live=True, solver: Optional[morphology_solver] = None, detection_width=DETECTION_WIDTH,  # type: ignore
+            camera_id: str = DEFAULT_CAMERA, stop=None, headless=False, motion_gate: Optional[MotionGate] = None, with_contours=False,
+            zones: Optional[DetectionZones] = None):
+    metrics.start_process(f"capture-{camera_id or 'camera'}")
+    if solver is None:
+        solver = fast_morphology_solver(
+            background_model=running_average_background())
 
-def capture(capture: VideoCapture, queue: multiprocessing.Queue):  # type: ignore
     MIN_RELATIVE_CONTOUR_AREA = 1.0 / 100
-    MIN_FRAME_RESET_CONTOUR_AREA = 0.1 / 100
-
-    def is_valid_contour(contour, bounding_rect, capture_area):
-        (x, y, w, h) = bounding_rect
-        area = cv2.contourArea(contour)
-        # relative_area = (area / capture_area)
-        relative_area = (w * h) / capture_area
-        if relative_area < MIN_RELATIVE_CONTOUR_AREA:
-            return False
-        return True
-        # aspect = w / h
 
     output_size = get_output_size(capture)
-    fps = get_predicted_fps(capture)
+    # sources that don't report a frame rate start with a default, the reader measures the real one as frames
+    # arrive and the ClipManager picks it up from the ring
+    fps = FpsEstimator(capture.get(cv2.CAP_PROP_FPS)).fps
 
     width, height = output_size
     max_width = min(1280, width)
@@ -69,71 +71,119 @@ def capture(capture: VideoCapture, queue: multiprocessing.Queue):  # type: ignor
     max_height = max_width//aspect
     processing_size = (int(max_width), int(max_height))
 
-    capture_area = processing_size[0] * processing_size[1]
-    queue.put((processing_size, fps))
-
+    detection_width = min(detection_width, processing_size[0])
+    detection_size = (int(detection_width), int(
+        round(processing_size[1] * detection_width / processing_size[0])))
+    # contours found at the detection size are scaled by this to get back to recording coordinates
+    detection_scale = np.array([processing_size[0] / detection_size[0],
+                                processing_size[1] / detection_size[1]])
+    detection_frame = np.empty(
+        (detection_size[1], detection_size[0], 3), np.uint8)
+
+    capture_area = detection_size[0] * detection_size[1]
+    # regions with a smaller bounding box are ignored
+    min_box_area = MIN_RELATIVE_CONTOUR_AREA * capture_area
+    box_scale = np.array([*detection_scale, *detection_scale])
+    # areas are sent in recording pixels
+    area_scale = detection_scale[0] * detection_scale[1]
+
+    (roi_x, roi_y, roi_width, roi_height) = (0, 0, *detection_size)
+    if zones is not None:
+        ((roi_x, roi_y, roi_width, roi_height),
+         zone_mask) = zones.region(detection_size)
+        solver.set_zone_mask(zone_mask, detection_size[0])
+
+    # frames are handed to the ClipManager through shared memory, only the slot index goes over the queue.
+    # Live devices drop frames if the ClipManager falls behind, files wait for a slot so that no frames are lost
+    ring = SharedFrameRing.create(
+        FRAME_RING_SLOTS, (processing_size[1], processing_size[0], 3))
+    ring_timeout = 0 if live else None
+    queue.put((camera_id, (processing_size, fps, ring.spec(), live)))
+    debug_viewer.advertise(camera_id, ring.spec())
+
+    # decodes and resizes frames into the ring ahead of detection. Frames that could not be given a slot are still
+    # detected on, and live devices skip to the newest frame when detection falls behind
+    reader = FrameReader(capture, processing_size, READ_LATEST if live else READ_ALL,
+                         ring=ring, ring_timeout=ring_timeout, media_timestamps=not live, initial_fps=fps).start()
+    slot: Optional[int] = None
     try:
         frame_count = 0
-        frames_since_last_reset = 0
-        fps_ms = int(1000//fps)
-        while True:
+        while stop is None or not stop.is_set():
             frame_start = time.time()
             current_frame: Mat
-            read_frame, raw_frame = capture.read()
+            with metrics.timed("read_wait"):
+                read_frame, slot, current_frame, timestamp = reader.read()  # type: ignore
             if read_frame == True:
-                current_frame = cv2.resize(
-                    raw_frame.copy(), (processing_size[0], processing_size[1]))
                 frame_count += 1
 
                 # show the original video frame
                 display("original", current_frame, False)
 
-                roi_x = 0
-                roi_y = 0
-                region_of_interest = current_frame[roi_y:, roi_x:]
-
-                (contours, _) = solver.solve(region_of_interest, debug=False)
-                matched_contours = []
-                has_large_contours = False
-                for contour in contours:
-                    bounding_rect = cv2.boundingRect(contour)
-                    area = cv2.contourArea(contour)
-                    if not is_valid_contour(contour, bounding_rect, capture_area):
-                        continue
-
-                    has_large_contours = True
-
-                    (x, y, w, h) = cast(
-                        tuple[int, int, int, int], bounding_rect)
-
-                    relative_area = (area / capture_area) * 100
-
-                    # re-adjust the coordinates so they appear in the correct
-                    # place on the original frame
-                    adjusted_y = y + roi_y
-                    adjusted_x = x + roi_x
+                if detection_size != processing_size:
+                    with metrics.timed("detection_resize"):
+                        cv2.resize(current_frame, detection_size,
+                                   dst=detection_frame, interpolation=cv2.INTER_AREA)
+                else:
+                    detection_frame = current_frame
 
-                    matched_contours.append(
-                        ((adjusted_x, adjusted_y, w, h), contour, relative_area))
+                region_of_interest = detection_frame[roi_y:roi_y +
+                                                     roi_height, roi_x:roi_x + roi_width]
 
-                if has_large_contours:
-                    frames_since_last_reset = 0
+                matched_contours = []
+                with metrics.timed("motion_gate"):
+                    solved = motion_gate is None or motion_gate.should_solve(
+                        region_of_interest)
+                if solved:
+                    with metrics.timed("solve"):
+                        (boxes, areas, indices) = solver.solve_regions(
+                            region_of_interest, min_box_area, debug=False)
+
+                    if len(boxes) != 0:
+                        # re-adjust the coordinates so they appear in the correct
+                        # place on the original frame
+                        adjusted = np.rint(
+                            (boxes + (roi_x, roi_y, 0, 0)) * box_scale).astype(int).tolist()
+                        relative_areas = (areas / capture_area * 100).tolist()
+                        recording_areas = (areas * area_scale).tolist()
+                        for i in range(len(boxes)):
+                            contour = None
+                            if with_contours:
+                                contour = ((solver.region_contour(indices[i]) + (roi_x, roi_y)) *
+                                           detection_scale).astype(np.int32)
+                            matched_contours.append(
+                                (tuple(adjusted[i]), contour, relative_areas[i], recording_areas[i]))
                 else:
-                    if frames_since_last_reset >= 600:
-                        frames_since_last_reset = 0
-                        # reference_frame = current_frame
-                        # print("Updated reference frame")
-                    else:
-                        frames_since_last_reset += 1
+                    metrics.increment("frames_gate_skipped")
+
+                if motion_gate is not None and solved:
+                    motion_gate.update(len(matched_contours) != 0)
 
                 contours = []
                 if len(matched_contours) != 0:
-                    contours = [(box, contour)
-                                for (box, contour, _) in matched_contours]
+                    contours = [(box, contour, area)
+                                for (box, contour, _, area) in matched_contours]
+
+                if not headless:
+                    # the frame in the ring belongs to the ClipManager once it is published, so draw on a copy
+                    current_frame = current_frame.copy()
+
+                metrics.increment("frames")
+                if slot is not None:
+                    ring.publish(
+                        slot, [box for (box, _, _) in contours], timestamp)
+                    queue.put((camera_id, (slot, contours)))
+                    slot = None
+                else:
+                    metrics.increment("frames_dropped")
+                if metrics.enabled():
+                    metrics.observe("frame", time.time() - frame_start)
+                    metrics.set_gauge("ring_in_use", ring.in_use)
+                    metrics.set_gauge("read_ahead_depth", reader.queue_depth)
 
-                queue.put((current_frame.copy(), contours))
+                if headless:
+                    continue
 
-                for (box, contour, area) in matched_contours:
+                for (box, contour, area, _) in matched_contours:
                     (x, y, w, h) = box
                     cv2.putText(current_frame, f"S: {area:.6}", (x - 20, y - 20),
                                 cv2.FONT_HERSHEY_SIMPLEX, 1.1, (255, 255, 255), 4, 2)
@@ -148,7 +198,7 @@ def capture(capture: VideoCapture, queue: multiprocessing.Queue):  # type: ignor
                 frame_end = time.time()
                 duration_s = frame_end - frame_start
                 # duration = int(duration_s * 1000)
-                wait = fps - duration_s
+                wait = 1 / reader.fps - duration_s
                 key = None
                 if wait > 0 and RUN_AT_FRAMERATE:
                     key = cv2.waitKey(int(wait * 1000.0))
@@ -165,8 +215,23 @@ def capture(capture: VideoCapture, queue: multiprocessing.Queue):  # type: ignor
                 break
     except Exception:
         print(traceback.format_exc())
-
-    print("ending subprocesses")
-    queue.put(True)
-    capture.release()
-    cv2.destroyAllWindows()
+    finally:
+        print("ending subprocesses")
+        reader.stop()
+        if slot is not None:
+            ring.release(slot)
+        queue.put((camera_id, True))
+        capture.release()
+        debug_viewer.withdraw(camera_id)
+        if not headless:
+            cv2.destroyAllWindows()
+
+        print(
+            f"{camera_id or 'camera'}: frames sent: {ring.written}, frames dropped: {ring.dropped}, frames skipped: {reader.dropped}")
+        if motion_gate is not None:
+            print(
+                f"{camera_id or 'camera'}: motion gate solved {motion_gate.solved} frames, skipped {motion_gate.skipped} ({motion_gate.skip_ratio:.1%})")
+        if not ring.wait_until_drained(timeout=30):
+            print("ClipManager did not release all frames before shutting down")
+        metrics.flush()
+        ring.close()
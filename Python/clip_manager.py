@@ -1,161 +1,553 @@
-import base64
 import datetime
 import json
 import multiprocessing
 import os
 from pathlib import Path
+from queue import Empty
+import signal
+import time
 import traceback
 from typing import Optional, Union, cast
-from urllib.parse import urljoin
 import cv2
 from cv2 import Mat
 import numpy as np
-import requests
+from api import ClipsApi
 import compressor
-
-
-class BoundingBoxWithContour():
-    def __init__(self, box: tuple[float, float, float, float], contour: np.ndarray) -> None:
-        self.bounding_box = box
-        self.contour = contour
-
-
-class FrameInfo():
-    def __init__(self, frame: Mat, frame_number: int, regions: list[BoundingBoxWithContour]) -> None:
-        self.frame = frame
-        self.frame_number = frame_number
-        self.regions = regions
-
-
-class ClipsApi():
-    def __init__(self, host) -> None:
-        self.host = host
-        self.session = requests.Session()
-        self.session.verify = False
-        pass
-
-    def _compute_timestamp_in_ms(self, fps: float, frame_number):
-        return int((frame_number / fps) * 1000)
-
-    def add_clip(self, dateRecorded: datetime.datetime, clip_path: Path, fps: float, detections: list[FrameInfo]):
-        with open(clip_path, "rb") as cf:
-
-            detection_data = []
-            for _, d in enumerate(detections):
-                for _, r in enumerate(d.regions):
-                    detection_data.append(
-                        {"timestamp": self._compute_timestamp_in_ms(fps, d.frame_number), "boundingBox": r.bounding_box})
-
-            data = cf.read()
-            url = self.make_url("/clips")
-            print(f"saving clip to API. Sending POST request to {url}")
-            r = self.session.post(url, json={
-                "dateRecorded": dateRecorded.isoformat(),
-                "data": base64.b64encode(data).decode(),
-                "detections": detection_data
-            })
-
-            r.raise_for_status()
-
-    def make_url(self, path):
-        return urljoin(self.host, path)
-
-
+from crops import CROP_COUNT, BestCrops
+import dvr
+from fps_estimator import FpsEstimator
+import metrics
+from frame_ring import RingSpec, SharedFrameRing
+from upload_spool import SPOOL_MAX_BYTES, UPLOAD_CONCURRENCY, SpoolUploader, UploadSpool
+from worker_pool import WorkerPool
+
+
+# fields of every detection, timestamps are in seconds since the start of the clip's video, boxes and areas are in
+# recording coordinates until the clip is closed, and in the coordinates of its video afterwards
+DETECTION_DTYPE = np.dtype([("frame_number", np.int32), ("timestamp", np.float64), ("x", np.int32), ("y", np.int32),
+                            ("w", np.int32), ("h", np.int32), ("area", np.float32)])
+# contours that are kept are simplified to within this many pixels of the original
+CONTOUR_EPSILON = 1.5
+
+
+# Detections of a clip in one record array that grows as needed, instead of an object per region per frame.
+# Contours are only kept for regions that were sent with one.
+class DetectionStore():
+    __slots__ = ("_records", "_count", "contours")
+
+    def __init__(self, capacity: int = 256) -> None:
+        self._records = np.empty(capacity, DETECTION_DTYPE)
+        self._count = 0
+        # index of the record to its simplified contour
+        self.contours: dict[int, np.ndarray] = {}
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def records(self):
+        return self._records[:self._count]
+
+    def add(self, frame_number: int, regions: "RegionsList", timestamp: float = 0):
+        if len(regions) == 0:
+            return
+        if self._count + len(regions) > len(self._records):
+            grown = np.empty(
+                max(2 * len(self._records), self._count + len(regions)), DETECTION_DTYPE)
+            grown[:self._count] = self.records
+            self._records = grown
+
+        for (box, contour, area) in regions:
+            if contour is not None:
+                self.contours[self._count] = cv2.approxPolyDP(
+                    contour, CONTOUR_EPSILON, True)
+            self._records[self._count] = (frame_number, timestamp, *box, area)
+            self._count += 1
+
+    def compact(self):
+        # drops the unused capacity, before the store is sent to a worker process
+        self._records = self._records[:self._count].copy()
+
+    def scale(self, factor: float):
+        records = self.records
+        for field in ["x", "y", "w", "h"]:
+            records[field] = np.rint(records[field] * factor)
+        records["area"] *= factor * factor
+        for (index, contour) in self.contours.items():
+            self.contours[index] = np.rint(
+                contour * factor).astype(contour.dtype)
+
+
+# Frames are encoded as they are appended, so only the detections are kept in memory for the lifetime of the clip.
+# With the DVR encoder every frame of the camera is already being recorded, the clip is frames start_index onwards of
+# the recording and is cut out of its segments once they have been written
 class Clip():
-    def __init__(self, api: ClipsApi | None, fps: float, output_size: tuple[int, int]) -> None:
-        self.frames: list[FrameInfo] = []
-        self.fps = fps
+    def __init__(self, spool: UploadSpool | None, fps: float, output_size: tuple[int, int], path: os.PathLike, settings: "ClipSettings",
+                 profile: Optional[compressor.EncodingProfile] = None, preset: Optional[str] = None,
+                 recorder: Optional[dvr.SegmentRecorder] = None, start_index: int = 0, drop_frames: bool = False) -> None:
+        self.detections = DetectionStore()
+        self.crops = BestCrops(settings.crop_count)
+        self.frame_count = 0
+        # the rate the clip is encoded at, the recording's rate for the DVR encoder
+        self.fps = recorder.fps if recorder is not None else fps
         self.output_size = output_size
-        self.api = api
-
-    def append(self, frame_info: FrameInfo) -> None:
-        self.frames.append(frame_info)
-
-    def write(self, path: os.PathLike):
-        path = Path(path)
-        p = multiprocessing.Process(target=self._write, args=(path,))
-        p.start()
-
-    def _write(self, path: os.PathLike):
+        self.spool = spool
+        self.started_at = time.time()
+        self.encoder = settings.encoder
+        self._profile = profile or settings.profile_for("")
+        self._preset = preset
+        self._writer: Optional[cv2.VideoWriter] = None
+        self._encoder: Optional[compressor.RawVideoEncoder] = None
+        self._recorder = recorder
+        self._start_index = start_index
+        self._segments: list[dvr.Segment] = []
+        self._clip_start = 0.0
+        self._clip_end = 0.0
+        self._clip_frames = 0
+        if self.encoder == ENCODER_DVR:
+            self.path = Path(path).with_suffix(".mp4")
+        elif self.encoder == ENCODER_PIPE:
+            self.path = Path(path).with_suffix(".mp4")
+            self._encoder = compressor.RawVideoEncoder(
+                self.path, self.fps, self.output_size, settings.crf, self._profile, self._preset, drop_frames=drop_frames)
+        else:
+            self.path = Path(path).with_suffix(".avi")
+            fourcc = cv2.VideoWriter.fourcc(*'XVID')
+            self._writer = cv2.VideoWriter(
+                str(self.path), fourcc, self.fps, self.output_size)
+        self._crf = settings.crf
+
+    def append(self, frame: Optional[Mat], regions: "RegionsList") -> None:
+        # frames are encoded 1 / fps apart, whenever they were captured, so detections are timestamped with their
+        # position in the video and stay over the frame they were found in
+        timestamp = self.frame_count / self.fps
+        with metrics.timed("clip_append"):
+            if self._encoder is not None:
+                if not self._encoder.write(cast(Mat, frame)):
+                    # the encode of a live camera is too far behind, the frame isn't in the video and neither are its
+                    # detections
+                    return
+            elif self._writer is not None:
+                self._writer.write(frame)
+        self.detections.add(self.frame_count, regions, timestamp)
+        if len(regions) != 0:
+            with metrics.timed("clip_crops"):
+                self.crops.add(frame, regions, timestamp)
+        self.frame_count += 1
+
+    def close(self):
+        # no more frames will be added, the encode may still be finishing afterwards
         print("start write")
-        fourcc = cv2.VideoWriter.fourcc(*'XVID')
-        out = cv2.VideoWriter(str(path), fourcc, self.fps, self.output_size)
-        for f in self.frames:
-            out.write(f.frame)
-
-        out.release()
-        print("start compress")
-        output_path = compressor.compress(path)
-        print("complete compress")
-        self._onComplete(Path(path), output_path)
+        self.detections.compact()
+        # profiles with a max_width encode a smaller video than the frames, detections are sent in its coordinates
+        scale = self._profile.output_scale(self.output_size)
+        if scale != 1:
+            self.detections.scale(scale)
+            self.crops.scale(scale)
+        if self._encoder is not None:
+            self._encoder.close()
+        elif self._writer is not None:
+            self._writer.release()
+            self._writer = None
+
+    def _recorded_range(self):
+        # seconds into the recording the clip covers, the recording has a constant frame rate
+        assert self._recorder is not None
+        return (self._start_index / self._recorder.fps, (self._start_index + self.frame_count) / self._recorder.fps)
+
+    def is_encoded(self):
+        if self._recorder is not None:
+            return self._recorder.recorded_until() >= self._recorded_range()[1]
+        return self._encoder is None or self._encoder.finished()
+
+    def end_encoding(self):
+        if self._encoder is not None:
+            with metrics.timed("clip_encode_wait"):
+                self._encoder.wait()
+            # from the first frame until the encode has finished
+            metrics.observe("clip_encode", time.time() - self.started_at)
+            print("complete encode")
+            # the encoder can't be sent to a worker process, and isn't needed after this point
+            self._encoder = None
+        if self._recorder is not None:
+            self._link_segments()
+
+    def _link_segments(self):
+        assert self._recorder is not None
+        (start, end) = self._recorded_range()
+        with metrics.timed("clip_encode_wait"):
+            while self._recorder.recorded_until() < end:
+                time.sleep(0.1)
+                self._recorder.poll()
+        segments = self._recorder.segments_between(start, end)
+        fps = self._recorder.fps
+        # the recorder can't be sent to a worker process either
+        self._recorder = None
+        if len(segments) == 0:
+            raise Exception(
+                f"The recording of {self.path} has already been removed, increase the DVR size")
+        self._segments = dvr.link_segments(
+            segments, self.path.with_name(f"{self.path.stem}_segments"))
+        # the clip starts on the keyframe before its first frame, so detections are that much later into it
+        self._clip_start = dvr.clip_start(self._segments, start)
+        lead_frames = int(round((start - self._clip_start) * fps))
+        records = self.detections.records
+        records["frame_number"] += lead_frames
+        records["timestamp"] = records["frame_number"] / fps
+        self.crops.shift(lead_frames / fps)
+        self._clip_end = end
+        self._clip_frames = lead_frames + self.frame_count
+        metrics.observe("clip_encode", time.time() - self.started_at)
+
+    def process(self):
+        # runs on a worker process once the clip has been encoded
+        output_path = self.path
+        if self.encoder == ENCODER_DVR:
+            with metrics.timed("clip_compress"):
+                dvr.remux(self._segments, self._clip_start, self._clip_end,
+                          self._clip_frames, self.path)
+        elif self.encoder == ENCODER_XVID:
+            print("start compress")
+            with metrics.timed("clip_compress"):
+                output_path = compressor.compress(
+                    self.path, self._crf, self._profile, self._preset)
+            print("complete compress")
+        self._onComplete(self.path, output_path)
 
     def _onComplete(self, path: Path, output_path: Path):
         print(f"Saved to {output_path}")
-        if (self.api is not None):
-            self.api.add_clip(datetime.datetime.utcnow(),
-                              output_path, self.fps, self.frames)
+        if path != output_path:
+            print(f"Removing original {path}")
+            os.remove(path)
+
+        if (self.spool is not None):
+            # uploaded in the background by the SpoolUploader
+            self.spool.commit(output_path, datetime.datetime.utcnow(),
+                              ClipsApi.detection_data(self.detections.records), self.crops.crop_data())
         else:
             print(
                 "API_BASE_URL not specified in environment variable, clip will not be uploaded")
-
-        print(f"Removing original {path}")
-        os.remove(path)
-        print(f"Removing compressed {output_path}")
-        os.remove(output_path)
+            print(f"Removing compressed {output_path}")
+            os.remove(output_path)
 
         # print(f"json output")
         # with open(output_path.with_suffix(".json"), "w") as f:
-        #     json.dump(self.frames, f, default=serializer, indent=2)
+        #     json.dump(self.detections.records, f, default=serializer, indent=2)
         print("done write")
 
 
 def serializer(obj):
-    if isinstance(obj, FrameInfo):
-        return {"frame_number": obj.frame_number, "regions": obj.regions}
-
-    if isinstance(obj, BoundingBoxWithContour):
-        return {"bounding_box": obj.bounding_box}
-
     if isinstance(obj, np.ndarray):
         return obj.tolist()
 
 
-RegionsList = list[tuple[tuple[float, float, float, float], np.ndarray]]
+# (box, contour or None, area) of every region found in a frame
+RegionsList = list[tuple[tuple[int, int, int, int], Optional[np.ndarray], float]]
+
+# clips are cut every clip_duration seconds for as long as there is motion
+CLIP_MODE_FIXED = "fixed"
+# one clip per event, which lasts until there has been no motion for post_roll_duration seconds. Events separated by
+# no more than merge_gap seconds after the post-roll are recorded as one clip, and clips are cut at max_duration
+CLIP_MODE_EVENT = "event"
+CLIP_MODES = [CLIP_MODE_FIXED, CLIP_MODE_EVENT]
+
+CLIP_DURATION = 10
+PRE_ROLL_DURATION = 2
+POST_ROLL_DURATION = 2
+MERGE_GAP_DURATION = 2
+MAX_CLIP_DURATION = 60
+# number of clips that can be compressed and uploaded at the same time
+CLIP_WORKERS = 2
+# relative change in the rate frames of a camera are delivered at before the ClipManager uses it
+FPS_CHANGE = 0.02
+# relative change in the delivered rate before a DVR recording is restarted at the new rate, which cuts the current
+# clip, so it is larger than FPS_CHANGE to not restart on every small fluctuation
+DVR_FPS_CHANGE = 0.1
+# seconds before a DVR recording whose ffmpeg has exited is started again
+DVR_RESTART_DELAY = 5
+# seconds between checks of every camera for finished encodes and segments, and of the pool for finished jobs
+PUMP_INTERVAL = 0.1
+# upper bound on the memory used by the pre-roll of a single camera, regardless of its duration
+PRE_ROLL_MAX_BYTES = 256 * 1024 * 1024
+
+
+# Keeps the most recent frames in preallocated slots so that a clip can include the frames from before motion
+# was detected. Frames are copied in, so pushing a frame never allocates. Without a frame_shape only the number of
+# frames is kept, for frames that are already being recorded elsewhere.
+class PreRollBuffer():
+    def __init__(self, capacity: int, frame_shape: Optional[tuple[int, int, int]]) -> None:
+        self.capacity = capacity
+        self._frames = np.empty((capacity, *frame_shape), np.uint8) if frame_shape is not None else None
+        self._start = 0
+        self._count = 0
+
+    @staticmethod
+    def for_duration(duration: float, fps: float, output_size: tuple[int, int], keep_frames: bool = True):
+        if not keep_frames:
+            return PreRollBuffer(int(duration * fps), None)
+        (width, height) = output_size
+        frame_shape = (height, width, 3)
+        max_frames = PRE_ROLL_MAX_BYTES // (width * height * 3)
+        return PreRollBuffer(min(int(duration * fps), max_frames), frame_shape)
+
+    def __len__(self):
+        return self._count
+
+    def push(self, frame: Optional[Mat]):
+        if self.capacity == 0:
+            return
+
+        if self._count == self.capacity:
+            index = self._start
+            self._start = (self._start + 1) % self.capacity
+        else:
+            index = (self._start + self._count) % self.capacity
+            self._count += 1
+        if self._frames is not None:
+            np.copyto(self._frames[index], frame)
+
+    def clear(self):
+        self._start = 0
+        self._count = 0
+
+    def drain(self, count: Optional[int] = None):
+        # oldest frame first, of the newest count frames. The buffer is empty afterwards
+        skip = 0 if count is None else max(0, self._count - count)
+        for i in range(skip, self._count):
+            index = (self._start + i) % self.capacity
+            yield self._frames[index] if self._frames is not None else None
+        self._start = 0
+        self._count = 0
+
+
+# frames are piped straight into a single ffmpeg H.264 encode
+ENCODER_PIPE = "pipe"
+# frames are written to an XVID .avi which is then re-encoded to H.264 by compressor.compress
+ENCODER_XVID = "xvid"
+# every frame is recorded into a ring of segments on disk by dvr.SegmentRecorder, clips are remuxed out of it
+ENCODER_DVR = "dvr"
+ENCODERS = [ENCODER_PIPE, ENCODER_XVID, ENCODER_DVR]
+
+
+class ClipSettings():
+    def __init__(self, clip_duration: float = CLIP_DURATION, pre_roll_duration: float = PRE_ROLL_DURATION, encoder: str = ENCODER_PIPE, crf: Optional[int] = None, workers: int = CLIP_WORKERS,
+                 spool_max_bytes: int = SPOOL_MAX_BYTES, upload_concurrency: int = UPLOAD_CONCURRENCY, mode: str = CLIP_MODE_FIXED,
+                 post_roll_duration: float = POST_ROLL_DURATION, merge_gap: float = MERGE_GAP_DURATION, max_duration: float = MAX_CLIP_DURATION,
+                 profile: str = compressor.DEFAULT_PROFILE, camera_profiles: Optional[dict[str, str]] = None,
+                 dvr_segment_duration: float = dvr.DVR_SEGMENT_DURATION, dvr_max_bytes: int = dvr.DVR_MAX_BYTES,
+                 crop_count: int = CROP_COUNT) -> None:
+        self.clip_duration = clip_duration
+        self.pre_roll_duration = pre_roll_duration
+        self.mode = mode
+        self.post_roll_duration = post_roll_duration
+        self.merge_gap = merge_gap
+        self.max_duration = max_duration
+        self.encoder = encoder
+        self.crf = crf
+        self.workers = workers
+        self.spool_max_bytes = spool_max_bytes
+        self.upload_concurrency = upload_concurrency
+        # names of compressor.PROFILES, cameras without their own profile use profile
+        self.profile = profile
+        self.camera_profiles = camera_profiles or {}
+        self.dvr_segment_duration = dvr_segment_duration
+        # disk space the segments of each camera can use
+        self.dvr_max_bytes = dvr_max_bytes
+        # crops of the best detections sent with each clip for the server to classify, 0 to send none
+        self.crop_count = crop_count
+
+    def profile_for(self, camera_id: str):
+        return compressor.PROFILES[self.camera_profiles.get(camera_id, self.profile)]
 
 
 class ClipManager():
-    def __init__(self, clipsApi: ClipsApi | None, output_size: tuple[int, int], fps: float, clip_duration) -> None:
+    def __init__(self, spool: UploadSpool | None, output_dir: Path, output_size: tuple[int, int], fps: float, settings: ClipSettings, pool: WorkerPool,
+                 camera_id: str = "", live: bool = False) -> None:
         self._match_started = False
+        self.camera_id = camera_id
+        # frames of live cameras are dropped from clips whose encode falls behind, files wait for the encode
+        self.live = live
+        self._pool = pool
+        # clips that have been closed but whose encode is still finishing
+        self._encoding: list[Clip] = []
+        self._output_dir = output_dir
+        self._frame_count = 0
         self.current_clip: Optional[Clip]
         self.fps: float = fps
+        # rate of the frames that reach the ClipManager. Frames skipped by the reader or dropped at the ring are
+        # never encoded, so clips are encoded at this rate rather than the camera's to play back in real time
+        self.delivered = FpsEstimator(fps)
         self.output_size = output_size
-        self._clip_duration = clip_duration
+        self._settings = settings
         self._clip_count = 0
-        self.api = clipsApi
+        # frames since the last motion in the current event, and frames held back in the pre-roll during a gap
+        self._since_motion = 0
+        self._held = 0
+        pre_roll_duration = settings.pre_roll_duration
+        if settings.mode == CLIP_MODE_EVENT:
+            # frames after the post-roll are held in the pre-roll buffer until the gap is over
+            pre_roll_duration = max(pre_roll_duration, settings.merge_gap)
+        self._pre_roll = PreRollBuffer.for_duration(
+            pre_roll_duration, fps, output_size, settings.encoder != ENCODER_DVR)
+        self._recorder: Optional[dvr.SegmentRecorder] = None
+        self._recorder_retry_at = 0.0
+        self.update_fps(fps)
+        self.spool = spool
+
+    def _start_recorder(self):
+        # every run of the camera, and every change in its frame rate, starts a new recording
+        try:
+            self._recorder = dvr.SegmentRecorder(self._output_dir.joinpath("dvr", self.camera_id or "camera"), self.fps,
+                                                 self.output_size, self._settings.profile_for(self.camera_id), self._settings.crf,
+                                                 self._settings.dvr_segment_duration, self._settings.dvr_max_bytes)
+        except OSError:
+            print(traceback.format_exc())
+            print(f"Could not start recording camera {self.camera_id}, retrying in {DVR_RESTART_DELAY}s")
+            self._recorder_retry_at = time.monotonic() + DVR_RESTART_DELAY
+
+    def _stop_recorder(self):
+        # the current clip is cut, clips keep the recorder until their segments have been linked
+        (_, clip) = self.try_complete()
+        if clip is not None:
+            self.finish(clip)
+        # the frames in the pre-roll belong to the recording that is stopping
+        self._pre_roll.clear()
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+
+    def _record(self, frame: Mat):
+        # False when the frame couldn't be recorded, clips can't include it
+        if self._recorder is None and time.monotonic() >= self._recorder_retry_at:
+            self._start_recorder()
+        if self._recorder is None:
+            return False
+        try:
+            self._recorder.write(frame)
+            return True
+        except OSError:
+            recorder = self._recorder
+            self._stop_recorder()
+            print(f"Recording of camera {self.camera_id} stopped, ffmpeg exited with code {recorder.returncode()}. "
+                  f"Restarting in {DVR_RESTART_DELAY}s")
+            metrics.increment("dvr_restarts")
+            self._recorder_retry_at = time.monotonic() + DVR_RESTART_DELAY
+            return False
+
+    def update_fps(self, fps: float):
+        # durations are converted to frames with the latest rate frames have been delivered at, the pre-roll buffer
+        # keeps the capacity it was created with
+        self.fps = fps
+        if self._recorder is not None and abs(fps - self._recorder.fps) > DVR_FPS_CHANGE * self._recorder.fps:
+            # the recording's rate is fixed, so it would play back at the wrong speed
+            print(f"Camera {self.camera_id} is now delivering {fps:.1f}fps, restarting its recording")
+            self._stop_recorder()
+            self._start_recorder()
+        self._pre_roll_frames = int(self._settings.pre_roll_duration * fps)
+        self._post_roll_frames = int(self._settings.post_roll_duration * fps)
+        self._max_frames = int(self._settings.max_duration * fps)
+        self._merge_gap_frames = 0
+        if self._settings.mode == CLIP_MODE_EVENT:
+            self._merge_gap_frames = min(
+                int(self._settings.merge_gap * fps), self._pre_roll.capacity)
 
     def try_start(self):
         if self._match_started:
             return False
         self._match_started = True
-        self.current_clip = Clip(self.api, self.fps, self.output_size)
-        self._clip_count = self.fps * self._clip_duration
+        pre_roll = min(len(self._pre_roll), self._pre_roll_frames)
+        name = f"{self._frame_count - pre_roll}"
+        if self.camera_id:
+            name = f"{self.camera_id}_{name}"
+        path = self._output_dir.joinpath(name)
+        profile = self._settings.profile_for(self.camera_id)
+        # every encode that is already running, for any camera, makes an adaptive profile use a faster preset
+        preset = profile.preset_for_backlog(
+            compressor.RawVideoEncoder.running_encodes() + self._pool.backlog)
+        # the current frame has already been recorded
+        start_index = self._recorder.frames_written - 1 - \
+            pre_roll if self._recorder is not None else 0
+        self.current_clip = Clip(self.spool, self.fps, self.output_size, path, self._settings, profile, preset,
+                                 self._recorder, start_index, self.live)
+        for frame in self._pre_roll.drain(pre_roll):
+            self.current_clip.append(frame, [])
+        # the delivered rate is rarely a whole number
+        self._clip_count = self.current_clip.frame_count + \
+            int(round(self.fps * self._settings.clip_duration))
+        self._since_motion = 0
+        self._held = 0
 
         return True
 
+    def buffer_frame(self, frame: Mat):
+        if self._match_started:
+            return False
+
+        self._frame_count += 1
+        self._pre_roll.push(frame)
+        return True
+
     def try_add_frame(self, frame: Mat, regions: RegionsList):
         if not self._match_started or self.current_clip is None:
             return False
 
-        self.current_clip.append(FrameInfo(frame, len(
-            self.current_clip.frames), [BoundingBoxWithContour(b, c) for (b, c) in regions]))
+        self._frame_count += 1
+        self.current_clip.append(frame, regions)
 
         return True
 
+    def add_frame(self, frame: Mat, regions: RegionsList):
+        # called with every frame of the camera
+        if self._settings.encoder == ENCODER_DVR and not self._record(frame):
+            return
+        if self._settings.mode == CLIP_MODE_EVENT:
+            self._add_event_frame(frame, regions)
+            return
+
+        if len(regions) != 0 or self._match_started:
+            self.try_start()
+            self.try_add_frame(frame, regions)
+            if self.should_complete():
+                self.finish(self.complete())
+        else:
+            self.buffer_frame(frame)
+
+    def _add_event_frame(self, frame: Mat, regions: RegionsList):
+        if not self._match_started:
+            if len(regions) == 0:
+                self.buffer_frame(frame)
+                return
+            self.try_start()
+
+        clip = cast(Clip, self.current_clip)
+        if len(regions) != 0:
+            # the event carries on, including the frames of the gap
+            for held in self._pre_roll.drain():
+                clip.append(held, [])
+            self._held = 0
+            self._since_motion = 0
+            self.try_add_frame(frame, regions)
+        elif self._since_motion < self._post_roll_frames:
+            self._since_motion += 1
+            self.try_add_frame(frame, regions)
+        elif self._held < self._merge_gap_frames:
+            self._frame_count += 1
+            self._pre_roll.push(frame)
+            self._held += 1
+        else:
+            # the event is over, the frames held back become the pre-roll of the next one
+            self.finish(self.complete())
+            self.buffer_frame(frame)
+            return
+
+        if clip.frame_count >= self._max_frames:
+            self.finish(self.complete())
+
     def should_complete(self):
         if not self._match_started or self.current_clip is None:
             return
 
-        return self._clip_count == len(self.current_clip.frames)
+        return self.current_clip.frame_count >= self._clip_count
 
     def complete(self):
         (success, clip) = self.try_complete()
@@ -168,73 +560,170 @@ class ClipManager():
 
         self._clip_count = 0
         self._match_started = False
+        self._since_motion = 0
+        self._held = 0
         clip = self.current_clip
         self.current_clip = None
         return (True, cast(Clip, clip))
 
+    def finish(self, clip: Clip):
+        metrics.increment("clips")
+        clip.close()
+        self._encoding.append(clip)
+        self.pump()
+
+    def pump(self):
+        # hands the clips that have finished encoding to the pool, the pool is pumped by its owner
+        if self._recorder is not None:
+            self._recorder.poll()
+        for clip in [c for c in self._encoding if c.is_encoded()]:
+            self._encoding.remove(clip)
+            self._submit(clip)
+
+    def close(self):
+        # the camera has stopped, clips that are still encoding are handed to the pool by pump() or flush()
+        self._stop_recorder()
+        self._pre_roll = PreRollBuffer(
+            0, (self.output_size[1], self.output_size[0], 3))
+
+    def is_idle(self):
+        return len(self._encoding) == 0
+
+    def flush(self):
+        # waits for every clip to be encoded and hands them all to the pool
+        for clip in self._encoding:
+            self._submit(clip)
+        self._encoding = []
+
+    def _submit(self, clip: Clip):
+        try:
+            clip.end_encoding()
+        except Exception:
+            print(traceback.format_exc())
+            return
+        # oldest clips are processed first
+        self._pool.submit(clip.process, clip.started_at)
+
     @staticmethod
-    def start(queue: multiprocessing.Queue, output_dir: os.PathLike):
+    def start(queue: multiprocessing.Queue, output_dir: os.PathLike, settings: ClipSettings):
+        # shutdown is driven by the None message, not ctrl+c or SIGTERM, so that clips in progress are always finished
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        metrics.start_process("clip-manager")
         output_dir = Path(output_dir)
-        CLIP_DURATION = 10
-        processed_first_message = False
-        frame_count = 0
-        output_size: tuple[int, int] = None  # type: ignore
-        fps: int = None  # type: ignore
-        clips: ClipManager = None  # type: ignore
+        pool = WorkerPool(settings.workers)
+
+        host = os.getenv("API_BASE_URL")
+        spool: UploadSpool | None = None
+        uploader: SpoolUploader | None = None
+        if host is not None:
+            spool = UploadSpool(output_dir.joinpath(
+                "spool"), settings.spool_max_bytes)
+            uploader = SpoolUploader(
+                spool, host, settings.upload_concurrency)
+            uploader.start()
+        else:
+            print(
+                "API_BASE_URL not specified in environment variable, clips will not be uploaded to the API")
+
+        # every camera hands over frames through its own ring, all of them share the worker pool and spool
+        streams: dict[str, tuple[SharedFrameRing, ClipManager]] = {}
+        # cameras that have stopped, but still have clips encoding
+        closing: list[ClipManager] = []
 
+        def close_stream(camera_id: str):
+            (ring, clips) = streams.pop(camera_id)
+            clips.close()
+            ring.close()
+            closing.append(clips)
+
+        next_pump = 0.0
         try:
             while True:
+                camera_id: Optional[str] = None
+                slot: Optional[int] = None
                 try:
-                    data: Union[tuple[tuple[int, int], int], tuple[Mat,
-                                                                   RegionsList], bool] = queue.get(block=True, timeout=3)
-
-                    if isinstance(data, bool):
-                        (_, clip) = clips.try_complete()
-                        if clip is not None:
-                            clip.write(output_dir.joinpath(
-                                f"{frame_count}_clip.avi"))
+                    # on a timer rather than every frame, the work grows with the number of cameras
+                    if time.monotonic() >= next_pump:
+                        next_pump = time.monotonic() + PUMP_INTERVAL
+                        for (_, clips) in streams.values():
+                            clips.pump()
+                        for clips in list(closing):
+                            clips.pump()
+                            if clips.is_idle():
+                                closing.remove(clips)
+                        pool.pump()
+
+                    try:
+                        message: Optional[tuple[str, Union[tuple[tuple[int, int], int, RingSpec, bool], tuple[int, RegionsList], bool]]] = queue.get(
+                            block=True, timeout=3)
+                    except Empty:
+                        continue
+
+                    if message is None:
                         break
-
-                    if not processed_first_message:
-                        processed_first_message = True
-                        output_size, fps = cast(
-                            tuple[tuple[int, int], int], data)
-                        host = os.getenv("API_BASE_URL")
-                        api: ClipsApi | None = None
-                        if host is not None:
-                            api = ClipsApi(host)
-                        else:
-                            print(
-                                "API_BASE_URL not specified in environment variable, clips will not be uploaded to the API")
-                        clips = ClipManager(
-                            api, output_size, fps, CLIP_DURATION)
-                    else:
-                        data = cast(tuple[Mat, RegionsList], data)
-                        frame_count += 1
-                        (frame, matches) = data
-
-                        if len(matches) != 0 or clips._match_started:
-                            clips.try_start()
-                            clips.try_add_frame(frame, matches)
-                            if clips.should_complete():
-                                clip = clips.complete()
-                                if clip is None:
-                                    raise Exception(
-                                        "Expected to recieve a clip")
-                                clip.write(output_dir.joinpath(
-                                    f"{frame_count}.avi"))
+                    if metrics.enabled():
+                        metrics.set_gauge("pool_backlog", pool.backlog)
+                        try:
+                            metrics.set_gauge("frame_queue_depth", queue.qsize())
+                        except NotImplementedError:
+                            # not available on macOS
+                            pass
+
+                    (camera_id, data) = message
+                    if isinstance(data, bool):
+                        if camera_id in streams:
+                            close_stream(camera_id)
+                        continue
+
+                    if len(data) == 4:
+                        # first message of a camera, or of a camera that has been restarted
+                        if camera_id in streams:
+                            close_stream(camera_id)
+                        output_size, fps, ring_spec, live = cast(
+                            tuple[tuple[int, int], int, RingSpec, bool], data)
+                        streams[camera_id] = (SharedFrameRing.attach(ring_spec), ClipManager(
+                            spool, output_dir, output_size, fps, settings, pool, camera_id, live))
+                        continue
+
+                    (slot, matches) = cast(tuple[int, RegionsList], data)
+                    (ring, clips) = streams[camera_id]
+                    frame = ring.frame(slot)
+                    metrics.increment("frames")
+
+                    # only follow changes that would noticeably change clip lengths
+                    clips.delivered.add(ring.timestamp(slot))
+                    fps = clips.delivered.fps
+                    if abs(fps - clips.fps) > FPS_CHANGE * clips.fps:
+                        clips.update_fps(fps)
+                    clips.add_frame(frame, matches)
 
                 except Exception:
-                    (_, clip) = clips.try_complete()
-                    if clip is not None:
-                        clip.write(output_dir.joinpath(
-                            f"{frame_count}_clip.avi"))
+                    if camera_id in streams:
+                        (_, clips) = streams[camera_id]
+                        (_, clip) = clips.try_complete()
+                        if clip is not None:
+                            clips.finish(clip)
                     print(traceback.format_exc())
+                finally:
+                    if slot is not None and camera_id in streams:
+                        streams[camera_id][0].release(slot)
         except Exception:
             print(traceback.format_exc())
 
+        for camera_id in list(streams):
+            close_stream(camera_id)
 
-def start_processing(process_queue: multiprocessing.Queue, output_dir: Path):
+        print("waiting for clips to finish")
+        for clips in closing:
+            clips.flush()
+        pool.drain()
+        if uploader is not None:
+            uploader.stop()
+        metrics.flush()
+
+
+def start_processing(process_queue: multiprocessing.Queue, output_dir: Path, settings: ClipSettings = ClipSettings()):
     if not output_dir.is_dir():
         raise Exception("Expected output_dir to be a directory")
 
@@ -242,8 +731,14 @@ def start_processing(process_queue: multiprocessing.Queue, output_dir: Path):
         os.mkdir(output_dir)
 
     p = multiprocessing.Process(
-        target=ClipManager.start, args=(process_queue, output_dir))
+        target=ClipManager.start, args=(process_queue, output_dir, settings))
     p.start()
+    return p
+
+
+def stop_processing(process_queue: multiprocessing.Queue):
+    # finishes every clip that is in progress, then stops the ClipManager process
+    process_queue.put(None)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,18 @@
 
 from concurrent.futures import thread
 import datetime
+import functools
 from multiprocessing import Process, process
 import os
 from pathlib import Path
+import queue
+import subprocess
 import threading
+import time
 from typing import Callable, Optional
 from ffmpeg import FFmpeg, Progress
+import numpy as np
+import metrics
 
 
 def map_compression_level_to_crf(preset):
@@ -18,13 +24,127 @@ def map_compression_level_to_crf(preset):
 
 # "ffmpeg -i input.mp4 -c:v libx265 -crf 28 output.mp4"
 
+# x264/x265 presets from slowest to fastest, adaptive profiles move along this as more clips are being encoded
+ADAPTIVE_PRESETS = ["medium", "fast", "veryfast", "superfast", "ultrafast"]
+X264_PRESETS = ["ultrafast", "superfast", "veryfast", "faster",
+                "fast", "medium", "slow", "slower", "veryslow"]
+# frames an encode can fall behind by before frames are dropped from it, about a second at 30fps
+ENCODER_QUEUE_FRAMES = 30
+# used when the encoder a profile asks for isn't available
+FALLBACK_CODEC = "libx264"
+# the option that sets the quality of each encoder from a crf on the x264 scale (0-51, lower is better). Encoders
+# that aren't here can't be used, they would silently ignore the crf
+QUALITY_OPTIONS: dict[str, Callable[[int], dict[str, str]]] = {
+    "libx264": lambda crf: {"crf": str(crf)},
+    "libx265": lambda crf: {"crf": str(crf)},
+    # constant quality with no bitrate limit
+    "h264_nvenc": lambda crf: {"rc": "vbr", "cq": str(crf), "b:v": "0"},
+    "hevc_nvenc": lambda crf: {"rc": "vbr", "cq": str(crf), "b:v": "0"},
+    "h264_qsv": lambda crf: {"global_quality": str(max(1, crf))},
+    "hevc_qsv": lambda crf: {"global_quality": str(max(1, crf))},
+    "h264_vaapi": lambda crf: {"qp": str(crf)},
+    "hevc_vaapi": lambda crf: {"qp": str(crf)},
+    # these go up to 63
+    "libvpx-vp9": lambda crf: {"crf": str(round(crf * 63 / 51)), "b:v": "0"},
+    "libaom-av1": lambda crf: {"crf": str(round(crf * 63 / 51)), "b:v": "0"},
+}
+
+
+@functools.cache
+def available_encoders() -> frozenset[str]:
+    try:
+        output = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"],
+                                capture_output=True, text=True).stdout
+    except OSError:
+        return frozenset()
+    # lines look like " V..... libx264    libx264 H.264 / AVC ..."
+    return frozenset(line.split()[1] for line in output.splitlines() if len(line.split()) > 1 and len(line.split()[0]) == 6)
+
+
+# Codec and tuning of an encode. codec can be any encoder in QUALITY_OPTIONS, and falls back to libx264 on hosts
+# that don't have it. tune is only used by x264/x265 ("zerolatency" encodes with less buffering, "fastdecode" is
+# cheaper to play back), threads=0 lets the encoder decide, and frames wider than max_width are scaled down. An
+# adaptive profile starts at its preset and moves to a faster one for every encode that is already running.
+class EncodingProfile():
+    def __init__(self, codec: str = "libx264", preset: Optional[str] = "medium", tune: Optional[str] = None, threads: int = 0,
+                 max_width: Optional[int] = None, adaptive=False) -> None:
+        if codec not in QUALITY_OPTIONS:
+            raise Exception(
+                f"Can't set the quality of {codec}, it must be one of {', '.join(QUALITY_OPTIONS)}")
+        self.codec = codec
+        self.preset = preset
+        self.tune = tune
+        self.threads = threads
+        self.max_width = max_width
+        self.adaptive = adaptive
+
+    def preset_for_backlog(self, backlog: int):
+        if not self.adaptive or self.preset not in ADAPTIVE_PRESETS:
+            return self.preset
+        index = ADAPTIVE_PRESETS.index(self.preset) + max(0, backlog)
+        return ADAPTIVE_PRESETS[min(index, len(ADAPTIVE_PRESETS) - 1)]
+
+    def output_scale(self, size: tuple[int, int]) -> float:
+        # how much the encode scales frames of size down by, see max_width
+        (width, _) = size
+        if self.max_width is None or width <= self.max_width:
+            return 1.0
+        return self.max_width / width
+
+    def output_options(self, crf: Optional[int], preset: Optional[str] = None) -> dict[str, str]:
+        codec = self.codec
+        encoders = available_encoders()
+        if len(encoders) == 0:
+            # the encode will fail too, falling back wouldn't help
+            print("ffmpeg is not installed or could not list its encoders, make sure it is on the PATH")
+        elif codec != FALLBACK_CODEC and codec not in encoders:
+            print(f"{codec} is not available, encoding with {FALLBACK_CODEC}")
+            codec = FALLBACK_CODEC
+        x26x = codec in ["libx264", "libx265"]
+
+        options = {"c:v": codec}
+        preset = preset or self.preset
+        if x26x and preset not in X264_PRESETS:
+            # presets of other encoders mean nothing to x264
+            preset = None
+        if preset is not None:
+            options["preset"] = preset
+        if self.tune is not None and x26x:
+            options["tune"] = self.tune
+        options.update(QUALITY_OPTIONS[codec](
+            crf if crf is not None else map_compression_level_to_crf("m")))
+        options["threads"] = str(self.threads)
+        # yuv420p needs even dimensions, and is what browsers can play back
+        filters = "crop=trunc(iw/2)*2:trunc(ih/2)*2"
+        if self.max_width is not None:
+            filters = f"scale='min({self.max_width},iw)':-2,{filters}"
+        options["vf"] = filters
+        options["pix_fmt"] = "yuv420p"
+        return options
+
+    def output_arguments(self, crf: Optional[int], preset: Optional[str] = None):
+        # output_options as ffmpeg command line arguments
+        return [v for (key, value) in self.output_options(crf, preset).items() for v in (f"-{key}", value)]
+
+
+PROFILES = {
+    # what every clip was encoded with before profiles
+    "quality": EncodingProfile(preset="medium"),
+    "balanced": EncodingProfile(preset="veryfast"),
+    "realtime": EncodingProfile(preset="ultrafast", tune="zerolatency"),
+    # for hosts with many cameras on few cores
+    "low-cpu": EncodingProfile(preset="ultrafast", tune="fastdecode", threads=1, max_width=640),
+    "adaptive": EncodingProfile(preset="medium", adaptive=True),
+}
+DEFAULT_PROFILE = "quality"
+
 
 class CompleteHolder():
     def __init__(self, onComplete) -> None:
         self.onComplete = onComplete
 
 
-def compress(filepath, crf: Optional[int] = None):
+def compress(filepath, crf: Optional[int] = None, profile: Optional[EncodingProfile] = None, preset: Optional[str] = None):
     print("calling compress")
     path = Path(filepath).resolve()
     output_path = path.with_suffix(".mp4")
@@ -32,11 +152,12 @@ def compress(filepath, crf: Optional[int] = None):
         output_path = output_path.with_stem(
             f"{datetime.datetime.utcnow().timestamp()}{output_path.stem}")
 
-    compress_core(path, crf, output_path)
+    compress_core(path, crf, output_path, profile, preset)
     return output_path
 
 
-def compress_core(path: Path, crf: Optional[int], output_path: Path):
+def compress_core(path: Path, crf: Optional[int], output_path: Path, profile: Optional[EncodingProfile] = None, preset: Optional[str] = None):
+    profile = profile or PROFILES[DEFAULT_PROFILE]
     ffmpeg = (
         FFmpeg()
         .option("y")
@@ -44,9 +165,7 @@ def compress_core(path: Path, crf: Optional[int], output_path: Path):
         .input(path)
         .output(
             output_path,
-            {"c:v": "libx264"},
-            preset="medium",
-            crf=crf if crf is not None else map_compression_level_to_crf("m"),
+            profile.output_options(crf, preset),
         )
     )
 
@@ -65,19 +184,165 @@ def compress_core(path: Path, crf: Optional[int], output_path: Path):
     ffmpeg.execute()
 
 
+# Encodes raw BGR frames written to ffmpeg's stdin directly to H.264, so that a clip is only encoded once. Frames are
+# copied and written to ffmpeg by a thread of the encoder's own, so that an encode that falls behind doesn't hold up
+# the caller, which feeds every camera. Once queue_frames frames are waiting, write() waits for ffmpeg, or with
+# drop_frames (for live cameras, which can't wait) the frame is dropped from the encode
+class RawVideoEncoder():
+    # encoders that have been started and not waited for, see running_encodes()
+    _started: list["RawVideoEncoder"] = []
+
+    def __init__(self, output_path: Path, fps: float, size: tuple[int, int], crf: Optional[int] = None, profile: Optional[EncodingProfile] = None,
+                 preset: Optional[str] = None, queue_frames: int = ENCODER_QUEUE_FRAMES, drop_frames: bool = False) -> None:
+        (width, height) = size
+        self.output_path = output_path
+        profile = profile or PROFILES[DEFAULT_PROFILE]
+        arguments = [
+            "ffmpeg", "-y", "-hide_banner", "-loglevel", "warning",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(fps),
+            "-i", "-",
+            *profile.output_arguments(crf, preset),
+            str(output_path)
+        ]
+        print("arguments:", arguments)
+        self._process = subprocess.Popen(arguments, stdin=subprocess.PIPE)
+        # frames waiting to be written, None once the encoder is closed. Buffers are only allocated while the queue
+        # is growing, and are reused once written
+        self._queue: queue.Queue[Optional[np.ndarray]] = queue.Queue()
+        self._free: list[np.ndarray] = []
+        self._buffers = 0
+        self._max_buffers = max(1, queue_frames)
+        self._drop_frames = drop_frames
+        self._freed = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_frames, daemon=True)
+        self._thread.start()
+        RawVideoEncoder._started.append(self)
+
+    @staticmethod
+    def running_encodes():
+        # number of encodes in this process that haven't finished, used to pick the preset of adaptive profiles
+        RawVideoEncoder._started = [
+            e for e in RawVideoEncoder._started if not e.finished()]
+        return len(RawVideoEncoder._started)
+
+    def write(self, frame: np.ndarray):
+        # False if the frame was dropped because the encode is too far behind
+        with self._freed:
+            while len(self._free) == 0 and self._buffers == self._max_buffers:
+                if self._drop_frames:
+                    metrics.increment("encode_frames_dropped")
+                    return False
+                with metrics.timed("encode_stall"):
+                    self._freed.wait()
+            if len(self._free) != 0:
+                buffer = self._free.pop()
+            else:
+                buffer = np.empty_like(frame)
+                self._buffers += 1
+        np.copyto(buffer, frame)
+        self._queue.put(buffer)
+        return True
+
+    def _write_frames(self):
+        stdin = self._process.stdin
+        assert stdin is not None
+        failed = False
+        while True:
+            buffer = self._queue.get()
+            if buffer is None:
+                break
+            if not failed:
+                try:
+                    with metrics.timed("encode_write"):
+                        stdin.write(buffer.data)
+                except OSError:
+                    # ffmpeg has exited, wait() reports it
+                    failed = True
+            with self._freed:
+                self._free.append(buffer)
+                self._freed.notify()
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+    def close(self):
+        # signals the end of the input once the queued frames are written, ffmpeg carries on encoding whatever it has
+        # buffered
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+
+    def finished(self):
+        return self._process.poll() is not None
+
+    def wait(self):
+        self.close()
+        self._thread.join()
+        returncode = self._process.wait()
+        if returncode != 0:
+            raise Exception(
+                f"ffmpeg exited with code {returncode} while encoding {self.output_path}")
+        return self.output_path
+
+
+def benchmark_profile(sample: Path, profile: EncodingProfile, crf: Optional[int], output_dir: Path):
+    # wall time, CPU time of ffmpeg and the size of the output, for encoding sample with profile
+    output_path = output_dir.joinpath("benchmark.mp4")
+    arguments = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-i", str(sample),
+                 *profile.output_arguments(crf), str(output_path)]
+    cpu_start = _children_cpu_seconds()
+    start = time.perf_counter()
+    subprocess.run(arguments, check=True)
+    elapsed = time.perf_counter() - start
+    cpu = _children_cpu_seconds()
+    result = {"seconds": elapsed, "cpu_seconds": cpu - cpu_start if cpu is not None and cpu_start is not None else None,
+              "bytes": os.path.getsize(output_path)}
+    os.remove(output_path)
+    return result
+
+
+def _children_cpu_seconds():
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
 if __name__ == "__main__":
     import argparse
     import sys
+    import tempfile
 
     parser = argparse.ArgumentParser("Compress video files")
     parser.add_argument("file", type=str)
     parser.add_argument("-c", metavar="Compression level",
-                        default="medium", choices=["h", "m", "l"])
+                        default="m", choices=["h", "m", "l"])
     parser.add_argument("-crf", type=int)
+    parser.add_argument("--profile", default=DEFAULT_PROFILE,
+                        choices=list(PROFILES))
+    parser.add_argument("--benchmark", nargs="?", const=",".join(PROFILES),
+                        help="Encode the file with each of these comma separated profiles (all by default) and compare them, instead of compressing it")
     args = parser.parse_args(sys.argv[1:])
     path = Path(args.file)
 
     crf = args.crf
     if crf is None:
         crf = map_compression_level_to_crf(args.c)
-    compress(args.file, crf)
+
+    if args.benchmark is None:
+        compress(args.file, crf, PROFILES[args.profile])
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        print(f"{'profile':<10} {'seconds':>8} {'cpu':>8} {'size':>10}")
+        for name in args.benchmark.split(","):
+            result = benchmark_profile(
+                path, PROFILES[name], crf, Path(output_dir))
+            cpu = f"{result['cpu_seconds']:.2f}" if result["cpu_seconds"] is not None else "-"
+            print(
+                f"{name:<10} {result['seconds']:>8.2f} {cpu:>8} {result['bytes'] / 1024:>8.0f}kB")
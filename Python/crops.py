@@ -0,0 +1,88 @@
+import base64
+import heapq
+from typing import Optional
+import cv2
+import numpy as np
+
+# input size of the classifier on the server (Web/Classification/EfficientNetLite4Settings.cs)
+CROP_SIZE = 224
+# crops sent with every clip
+CROP_COUNT = 3
+# frames with motion between the frames crops are taken from, consecutive frames would give near identical crops
+CROP_INTERVAL = 5
+# crops are squares this much larger than the region, so the classifier sees some of what is around it
+CROP_PADDING = 1.2
+JPEG_QUALITY = 90
+
+# {"timestamp": ms since the start of the clip, "boundingBox": (x, y, w, h), "image": base64 JPEG}
+CropData = list[dict]
+
+
+# Keeps the best `count` crops of the regions in a clip, so the server can classify them without decoding the clip.
+# Crops are scored by the area of their region times their sharpness (variance of the Laplacian), so large objects
+# win over small ones unless they are blurred by motion. Only the largest region of a frame is considered.
+class BestCrops():
+    def __init__(self, count: int = CROP_COUNT, interval: int = CROP_INTERVAL) -> None:
+        self.count = count
+        self.interval = max(1, interval)
+        # min-heap of (score, timestamp, box, crop), the worst crop is replaced first
+        self._heap: list[tuple[float, float, tuple[int, int, int, int], np.ndarray]] = []
+        self._frames = 0
+        self._gray = np.empty((CROP_SIZE, CROP_SIZE), np.uint8)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, frame: Optional[np.ndarray], regions: list, timestamp: float):
+        # regions are clip_manager.RegionsList, in the coordinates of frame
+        if self.count == 0 or frame is None or len(regions) == 0:
+            return
+        self._frames += 1
+        if (self._frames - 1) % self.interval != 0:
+            return
+
+        (box, _, area) = max(regions, key=lambda region: region[2])
+        box = tuple(int(v) for v in box)
+        crop = self._crop(frame, box)
+        if crop is None:
+            return
+        cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        sharpness = cv2.Laplacian(self._gray, cv2.CV_32F).var()
+        item = (float(area * sharpness), timestamp, box, crop)
+        if len(self._heap) < self.count:
+            heapq.heappush(self._heap, item)
+        elif item[0] > self._heap[0][0]:
+            heapq.heapreplace(self._heap, item)
+
+    def _crop(self, frame: np.ndarray, box: tuple[int, int, int, int]):
+        # a square around the box, moved inside the frame where it would go over an edge
+        (x, y, w, h) = box
+        (height, width) = frame.shape[:2]
+        side = min(int(max(w, h) * CROP_PADDING), width, height)
+        if side <= 0:
+            return None
+        left = min(max(0, x + w // 2 - side // 2), width - side)
+        top = min(max(0, y + h // 2 - side // 2), height - side)
+        return cv2.resize(frame[top:top + side, left:left + side], (CROP_SIZE, CROP_SIZE), interpolation=cv2.INTER_AREA)
+
+    def shift(self, seconds: float):
+        # for when the clip ends up starting earlier than its first frame
+        self._heap = [(score, timestamp + seconds, box, crop)
+                      for (score, timestamp, box, crop) in self._heap]
+
+    def scale(self, factor: float):
+        # for when the clip is encoded at a different size than the frames the crops were taken from
+        self._heap = [(score, timestamp, tuple(int(round(v * factor)) for v in box), crop)
+                      for (score, timestamp, box, crop) in self._heap]
+
+    def crop_data(self) -> CropData:
+        # best crop first
+        data = []
+        for (_, timestamp, box, crop) in sorted(self._heap, key=lambda item: item[0], reverse=True):
+            (ok, jpeg) = cv2.imencode(
+                ".jpg", crop, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+            if not ok:
+                continue
+            data.append({"timestamp": int(round(timestamp * 1000)), "boundingBox": list(box),
+                         "image": base64.b64encode(jpeg.tobytes()).decode()})
+        return data
@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+from pathlib import Path
+import sys
+import tempfile
+import cv2
+from frame_ring import RingSpec, SharedFrameRing
+
+# capture processes write the spec of their frame ring here, so that a viewer can attach to them at any time
+RINGS_DIR = Path(tempfile.gettempdir()).joinpath("camera-rings")
+
+
+def _ring_file(camera_id: str):
+    return RINGS_DIR.joinpath(f"{camera_id or 'camera'}-{os.getpid()}.json")
+
+
+def advertise(camera_id: str, spec: RingSpec):
+    try:
+        RINGS_DIR.mkdir(exist_ok=True)
+        with open(_ring_file(camera_id), "w") as f:
+            json.dump({"camera": camera_id, "spec": spec}, f)
+    except OSError:
+        print(f"Could not advertise the frame ring of {camera_id or 'camera'} to debug viewers")
+
+
+def withdraw(camera_id: str):
+    try:
+        os.remove(_ring_file(camera_id))
+    except OSError:
+        pass
+
+
+def find_rings() -> dict[Path, tuple[str, RingSpec]]:
+    rings = {}
+    if not RINGS_DIR.exists():
+        return rings
+    for path in RINGS_DIR.glob("*.json"):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            rings[path] = (data["camera"], tuple(data["spec"]))
+        except (OSError, ValueError, KeyError):
+            continue
+    return rings
+
+
+# Shows the most recent frame published by a headless capture process, with its bounding boxes. The viewer only
+# reads from the ring and never holds a slot, so it can be started and closed without affecting capture. A frame
+# can occasionally be shown half overwritten.
+def view(path: Path, camera_id: str, spec: RingSpec):
+    try:
+        ring = SharedFrameRing.attach(spec)
+    except FileNotFoundError:
+        print(f"The capture process for {camera_id or 'camera'} is no longer running")
+        withdraw_stale(path)
+        return
+
+    window = f"camera {camera_id}" if camera_id else "camera"
+    last_written = -1
+    try:
+        while path.exists():
+            written = ring.written
+            if written != last_written:
+                last_written = written
+                slot = ring.last_slot
+                frame = ring.frame(slot).copy()
+                for (x, y, w, h) in ring.boxes(slot):
+                    cv2.rectangle(frame, (int(x), int(y)),
+                                  (int(x + w), int(y + h)), (0, 255, 0), 1)
+                cv2.imshow(window, frame)
+            key = cv2.waitKey(15)
+            if key & 0xFF == ord("q"):
+                break
+    finally:
+        ring.close()
+        cv2.destroyAllWindows()
+
+
+def withdraw_stale(path: Path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="View a camera that is running headless")
+    parser.add_argument("camera", nargs="?", default=None,
+                        help="Id of the camera to view, can be left out if only one camera is running")
+    args = parser.parse_args(sys.argv[1:])
+
+    rings = find_rings()
+    matches = [(path, camera, spec) for (path, (camera, spec)) in rings.items()
+               if args.camera is None or camera == args.camera]
+    if len(matches) != 1:
+        if len(matches) == 0:
+            print("No matching cameras are running")
+        else:
+            print("More than one camera is running, choose one of:")
+        for (camera, _) in rings.values():
+            print(f"  {camera or '(default)'}")
+        exit(1)
+
+    view(*matches[0])
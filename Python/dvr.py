@@ -0,0 +1,182 @@
+import math
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import time
+from typing import Optional
+import numpy as np
+from compressor import EncodingProfile
+import metrics
+
+# Continuous recording of a camera into fixed length segments, in a directory that is capped in size by removing the
+# oldest segments. Clips are cut out of the segments by remuxing them, without encoding the video again.
+
+DVR_SEGMENT_DURATION = 10
+DVR_MAX_BYTES = 10 * 1024 * 1024 * 1024
+# a keyframe is forced every this many seconds, clips start on the keyframe at or before their first frame
+KEYFRAME_INTERVAL = 1
+# matroska can be read while it is being written, and remuxes cleanly with the concat demuxer
+SEGMENT_FORMAT = "matroska"
+SEGMENT_EXTENSION = ".mkv"
+
+
+class Segment():
+    def __init__(self, path: Path, start: float, end: float) -> None:
+        self.path = path
+        # seconds since the recording started
+        self.start = start
+        self.end = end
+
+
+# Encodes every frame written to it into segments with one ffmpeg process. Segments of each recording go into their
+# own directory under `directory`, and the size of all of them together is kept under max_bytes.
+class SegmentRecorder():
+    def __init__(self, directory: Path, fps: float, size: tuple[int, int], profile: EncodingProfile, crf: Optional[int] = None,
+                 segment_duration: float = DVR_SEGMENT_DURATION, max_bytes: int = DVR_MAX_BYTES) -> None:
+        (width, height) = size
+        self.root = directory
+        self.directory = directory.joinpath(str(int(time.time() * 1000)))
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.fps = fps
+        self.max_bytes = max_bytes
+        self.frames_written = 0
+        self.segments: list[Segment] = []
+        self._list_path = self.directory.joinpath("segments.csv")
+        self._list_offset = 0
+        arguments = [
+            "ffmpeg", "-y", "-hide_banner", "-loglevel", "warning",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(fps),
+            "-i", "-",
+            *profile.output_arguments(crf),
+            "-force_key_frames", f"expr:gte(t,n_forced*{KEYFRAME_INTERVAL})",
+            # otherwise timestamps are delayed by the B-frames, and segments no longer start on frame n / fps
+            "-avoid_negative_ts", "disabled",
+            "-f", "segment", "-segment_time", str(segment_duration), "-segment_format", SEGMENT_FORMAT,
+            "-reset_timestamps", "1", "-segment_list", str(self._list_path), "-segment_list_type", "csv",
+            str(self.directory.joinpath(f"segment_%08d{SEGMENT_EXTENSION}"))
+        ]
+        print("arguments:", arguments)
+        self._process = subprocess.Popen(arguments, stdin=subprocess.PIPE)
+
+    def write(self, frame: np.ndarray):
+        assert self._process.stdin is not None
+        with metrics.timed("dvr_write"):
+            self._process.stdin.write(np.ascontiguousarray(frame).data)
+        self.frames_written += 1
+
+    def poll(self):
+        # picks up the segments ffmpeg has finished since the last call, and removes the oldest if over the cap
+        try:
+            with open(self._list_path) as f:
+                f.seek(self._list_offset)
+                lines = f.read()
+        except FileNotFoundError:
+            return
+        # a line is only complete once its newline has been written
+        complete = lines[:lines.rfind("\n") + 1]
+        self._list_offset += len(complete)
+        added = False
+        for line in complete.splitlines():
+            (name, start, end) = line.rsplit(",", 2)
+            self.segments.append(
+                Segment(self.directory.joinpath(name), float(start), float(end)))
+            added = True
+        if added:
+            metrics.increment("dvr_segments")
+            self._prune()
+
+    def _prune(self):
+        files = sorted(self.root.glob(f"*/*{SEGMENT_EXTENSION}"),
+                       key=lambda p: p.stat().st_mtime)
+        finished = {s.path for s in self.segments}
+        total = sum(p.stat().st_size for p in files)
+        for path in files:
+            if total <= self.max_bytes:
+                break
+            # segments of this recording that ffmpeg is still writing are kept
+            if path.parent == self.directory and path not in finished:
+                continue
+            total -= path.stat().st_size
+            os.remove(path)
+        self.segments = [s for s in self.segments if s.path.exists()]
+        for directory in self.root.iterdir():
+            if directory != self.directory and directory.is_dir() and not any(directory.glob(f"*{SEGMENT_EXTENSION}")):
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def recorded_until(self):
+        # seconds of the recording that are in finished segments
+        if self._process.poll() is not None:
+            self.poll()
+            return math.inf
+        return self.segments[-1].end if len(self.segments) != 0 else 0
+
+    def segments_between(self, start: float, end: float):
+        return [s for s in self.segments if s.end > start and s.start < end]
+
+    def returncode(self):
+        return self._process.poll()
+
+    def close(self):
+        # the last segment is finished once ffmpeg exits
+        assert self._process.stdin is not None
+        try:
+            if not self._process.stdin.closed:
+                self._process.stdin.close()
+        except BrokenPipeError:
+            # ffmpeg has already exited
+            pass
+        returncode = self._process.wait()
+        if returncode != 0:
+            print(f"ffmpeg exited with code {returncode} while recording to {self.directory}")
+        self.poll()
+
+
+def link_segments(segments: list[Segment], directory: Path):
+    # hard links keep the segments of a clip around if they are pruned before the clip is cut, and cost nothing.
+    # Copies are made where the file system doesn't support them
+    directory.mkdir(parents=True, exist_ok=True)
+    linked = []
+    for segment in segments:
+        path = directory.joinpath(f"{segment.path.parent.name}_{segment.path.name}")
+        try:
+            os.link(segment.path, path)
+        except OSError:
+            shutil.copyfile(segment.path, path)
+        linked.append(Segment(path, segment.start, segment.end))
+    return linked
+
+
+def clip_start(segments: list[Segment], start: float):
+    # the stream copy starts on a keyframe, keyframes are forced at every KEYFRAME_INTERVAL seconds of the recording
+    keyframe = math.floor(start / KEYFRAME_INTERVAL + 1e-6) * KEYFRAME_INTERVAL
+    return max(segments[0].start, keyframe)
+
+
+def remux(segments: list[Segment], start: float, end: float, frame_count: int, output_path: Path):
+    # copies frame_count frames from start to end seconds into the recording out of segments into output_path. start
+    # must be a keyframe, see clip_start(). The segments are removed afterwards
+    list_path = output_path.with_suffix(".segments.txt")
+    with open(list_path, "w") as f:
+        for (i, segment) in enumerate(segments):
+            f.write(f"file '{segment.path.resolve()}'\n")
+            # timestamps start from 0 in every segment
+            if i == 0:
+                f.write(f"inpoint {start - segment.start:.3f}\n")
+            if i == len(segments) - 1:
+                f.write(f"outpoint {end - segment.start:.3f}\n")
+    arguments = [
+        "ffmpeg", "-y", "-hide_banner", "-loglevel", "warning",
+        "-f", "concat", "-safe", "0", "-i", str(list_path),
+        "-frames:v", str(frame_count), "-c", "copy", "-movflags", "+faststart", str(output_path)
+    ]
+    try:
+        with metrics.timed("dvr_remux"):
+            subprocess.run(arguments, check=True)
+    finally:
+        os.remove(list_path)
+        for segment in segments:
+            os.remove(segment.path)
+        if len(segments) != 0:
+            shutil.rmtree(segments[0].path.parent, ignore_errors=True)
+    return output_path
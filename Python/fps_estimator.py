@@ -0,0 +1,30 @@
+from collections import deque
+from typing import Optional
+
+# frames the rate is measured over
+FPS_WINDOW = 120
+# timestamps needed before the measured rate is used
+MIN_SAMPLES = 10
+# used until then, when the source doesn't report a frame rate
+DEFAULT_FPS = 30.0
+
+
+# Measures the frame rate of a source from the timestamps of the frames it has produced, so that detection can start
+# on the first frame instead of reading frames up front to time them. The rate is the average over the last window
+# frames, which follows a device that changes its rate (e.g. lowering it in poor light).
+class FpsEstimator():
+    def __init__(self, initial_fps: Optional[float] = None, window: int = FPS_WINDOW) -> None:
+        self.initial_fps = initial_fps if initial_fps else DEFAULT_FPS
+        self._timestamps: deque[float] = deque(maxlen=max(2, window))
+
+    def add(self, timestamp: float):
+        self._timestamps.append(timestamp)
+
+    @property
+    def fps(self) -> float:
+        if len(self._timestamps) < MIN_SAMPLES:
+            return self.initial_fps
+        span = self._timestamps[-1] - self._timestamps[0]
+        if span <= 0:
+            return self.initial_fps
+        return (len(self._timestamps) - 1) / span
@@ -0,0 +1,158 @@
+from queue import Empty, Full, Queue
+import threading
+import time
+import traceback
+from typing import Optional
+import cv2
+from cv2 import VideoCapture
+import numpy as np
+from fps_estimator import FpsEstimator
+from frame_ring import SharedFrameRing
+import metrics
+
+# live devices: when the detector falls behind the oldest waiting frame is dropped, so it always gets the newest
+READ_LATEST = "latest"
+# files: the reader waits for the detector, no frame is ever dropped
+READ_ALL = "all"
+
+# frames decoded ahead of the detector
+FRAME_PREFETCH = 2
+
+# FrameItem is (ring slot, buffer index, frame, timestamp)
+FrameItem = tuple[Optional[int], int, np.ndarray, float]
+
+
+# Decodes and resizes frames on a background thread, so that decoding overlaps with detection (OpenCV releases the
+# GIL while it decodes and resizes). When a ring is given frames are resized straight into its slots, otherwise
+# into a small set of recycled buffers. A frame returned by read() is only valid until the next call to read().
+# Every frame is timestamped as it is decoded, in seconds: with the position in the video for files (media_timestamps)
+# and with the time it arrived otherwise. The timestamps of every frame, including skipped ones, measure the frame
+# rate of the source.
+class FrameReader():
+    def __init__(self, capture: VideoCapture, size: tuple[int, int], policy: str = READ_ALL, prefetch: int = FRAME_PREFETCH,  # type: ignore
+                 ring: Optional[SharedFrameRing] = None, ring_timeout: Optional[float] = 0, media_timestamps=False, initial_fps: Optional[float] = None) -> None:
+        self._capture = capture
+        self._media_timestamps = media_timestamps
+        self._last_timestamp = -1.0
+        self._estimator = FpsEstimator(initial_fps)
+        self._size = size
+        self._policy = policy
+        self._ring = ring
+        self._ring_timeout = ring_timeout
+        if ring is not None and prefetch + 2 >= ring.slot_count:
+            raise Exception(
+                "The ring must have more slots than the frames the reader can hold")
+
+        self._queue: Queue[Optional[FrameItem]] = Queue(
+            maxsize=max(1, prefetch))
+        # for frames that could not be given a ring slot: one being written, up to prefetch waiting and one being
+        # used by the detector
+        (width, height) = size
+        self._buffers = np.empty(
+            (max(1, prefetch) + 2, height, width, 3), np.uint8)
+        self._free_buffers: Queue[int] = Queue()
+        for i in range(len(self._buffers)):
+            self._free_buffers.put(i)
+        self._held_buffer = -1
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.dropped = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _next_destination(self):
+        slot = self._ring.acquire(
+            self._ring_timeout) if self._ring is not None else None
+        if slot is not None:
+            return (slot, -1, self._ring.frame(slot))  # type: ignore
+        buffer = self._free_buffers.get()
+        return (None, buffer, self._buffers[buffer])
+
+    def _recycle(self, slot: Optional[int], buffer: int):
+        if slot is not None and self._ring is not None:
+            # never published, so the slot can go straight back to the ring
+            self._ring.release(slot)
+        if buffer != -1:
+            self._free_buffers.put(buffer)
+
+    def _put(self, item: Optional[FrameItem]):
+        while True:
+            try:
+                self._queue.put(
+                    item, block=self._policy == READ_ALL, timeout=0.1)
+                return
+            except Full:
+                # frames are only dropped from live devices, or once the reader is stopping
+                if self._policy == READ_LATEST or self._stop.is_set():
+                    self._drop_oldest()
+
+    def _drop_oldest(self):
+        try:
+            dropped = self._queue.get_nowait()
+        except Empty:
+            return
+        if dropped is None:
+            return
+        (slot, buffer, _, _) = dropped
+        self.dropped += 1
+        metrics.increment("frames_skipped")
+        self._recycle(slot, buffer)
+
+    def _timestamp(self):
+        if self._media_timestamps:
+            timestamp = self._capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            if timestamp > self._last_timestamp:
+                self._last_timestamp = timestamp
+                return timestamp
+            # the backend doesn't know the position, so use arrival times from here on
+            print("Video positions are not available, timestamping frames as they are read")
+            self._media_timestamps = False
+        return time.monotonic()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                with metrics.timed("read"):
+                    (ok, raw_frame) = self._capture.read()
+                if not ok:
+                    break
+                timestamp = self._timestamp()
+                self._estimator.add(timestamp)
+                (slot, buffer, frame) = self._next_destination()
+                with metrics.timed("resize"):
+                    cv2.resize(raw_frame, self._size, dst=frame)
+                self._put((slot, buffer, frame, timestamp))
+        except Exception:
+            print(traceback.format_exc())
+        self._put(None)
+
+    @property
+    def fps(self):
+        # frame rate of the source, measured from the frames read so far
+        return self._estimator.fps
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def read(self) -> tuple[bool, Optional[int], Optional[np.ndarray], float]:
+        # (False, None, None, 0) once the video has ended or the reader was stopped. A ring slot that is returned
+        # must be published or released by the caller.
+        self._recycle(None, self._held_buffer)
+        self._held_buffer = -1
+        item = self._queue.get()
+        if item is None:
+            # the next read() sees the end again
+            self._queue.put(None)
+            return (False, None, None, 0)
+        (slot, self._held_buffer, frame, timestamp) = item
+        return (True, slot, frame, timestamp)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+        # slots of frames that were never read go back to the ring
+        while not self._queue.empty():
+            self._drop_oldest()
@@ -0,0 +1,169 @@
+from multiprocessing import resource_tracker, shared_memory
+import os
+import sys
+import time
+from typing import Optional
+import numpy as np
+
+SLOT_FREE = 0
+SLOT_READY = 1
+SLOT_WRITING = 2
+
+_STAT_WRITTEN = 0
+_STAT_DROPPED = 1
+_STAT_LAST_SLOT = 2
+_STAT_COUNT = 4
+
+# bounding boxes (x, y, w, h) kept with each frame, for the debug viewer
+MAX_BOXES = 16
+
+RingSpec = tuple[str, int, tuple[int, int, int]]
+
+
+# Fixed number of frame slots in shared memory, used to hand frames from the capture process to the ClipManager
+# process without pickling them - only slot indices go over the queue.
+# Single producer, single consumer: the producer acquire()s slots in order, writes into frame(slot) and publish()es
+# it, the consumer reads frame(slot) and release()s it once it no longer needs the data.
+class SharedFrameRing():
+    def __init__(self, shm: shared_memory.SharedMemory, slot_count: int, frame_shape: tuple[int, int, int], owner: bool) -> None:
+        self._shm = shm
+        self._owner = owner
+        self.slot_count = slot_count
+        self.frame_shape = frame_shape
+        self._next_slot = 0
+
+        # states, stats, box counts, boxes, timestamps, frames
+        offset = 0
+        self._states = np.ndarray((slot_count,), np.uint8, shm.buf, offset)
+        offset += _align(slot_count)
+        self._stats = np.ndarray((_STAT_COUNT,), np.uint64, shm.buf, offset)
+        offset += self._stats.nbytes
+        self._box_counts = np.ndarray((slot_count,), np.uint8, shm.buf, offset)
+        offset += _align(slot_count)
+        self._boxes = np.ndarray(
+            (slot_count, MAX_BOXES, 4), np.int32, shm.buf, offset)
+        offset += self._boxes.nbytes
+        self._timestamps = np.ndarray(
+            (slot_count,), np.float64, shm.buf, offset)
+        offset += self._timestamps.nbytes
+        self._frames = np.ndarray(
+            (slot_count, *frame_shape), np.uint8, shm.buf, offset)
+
+    @staticmethod
+    def _size(slot_count: int, frame_shape: tuple[int, int, int]):
+        return (2 * _align(slot_count) + _STAT_COUNT * np.dtype(np.uint64).itemsize +
+                slot_count * MAX_BOXES * 4 * np.dtype(np.int32).itemsize + slot_count * np.dtype(np.float64).itemsize +
+                slot_count * int(np.prod(frame_shape)))
+
+    @staticmethod
+    def create(slot_count: int, frame_shape: tuple[int, int, int]):
+        shm = shared_memory.SharedMemory(
+            create=True, size=SharedFrameRing._size(slot_count, frame_shape))
+        ring = SharedFrameRing(shm, slot_count, frame_shape, True)
+        ring._states[:] = SLOT_FREE
+        ring._stats[:] = 0
+        ring._box_counts[:] = 0
+        ring._timestamps[:] = 0
+        return ring
+
+    @staticmethod
+    def attach(spec: RingSpec):
+        (name, slot_count, frame_shape) = spec
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            # a tracker inherited from a parent process (one this process did not start) is shared with the creator,
+            # and unregistering the memory there would remove the creator's registration instead
+            tracker = resource_tracker._resource_tracker  # type: ignore
+            shared_tracker = tracker._fd is not None and tracker._pid is None
+            shm = shared_memory.SharedMemory(name=name)
+            # only the creator unlinks the memory, stop the resource tracker of this process from doing so on exit
+            if os.name == "posix" and not shared_tracker:
+                resource_tracker.unregister(
+                    shm._name, "shared_memory")  # type: ignore
+        return SharedFrameRing(shm, slot_count, tuple(frame_shape), False)  # type: ignore
+
+    def spec(self) -> RingSpec:
+        return (self._shm.name, self.slot_count, self.frame_shape)
+
+    def acquire(self, timeout: Optional[float] = 0) -> Optional[int]:
+        # wait up to timeout seconds (forever if None) for the consumer to release the next slot, otherwise the
+        # frame is dropped and counted
+        slot = self._next_slot
+        if self._states[slot] != SLOT_FREE:
+            start = time.monotonic()
+            while self._states[slot] != SLOT_FREE:
+                if timeout is not None and time.monotonic() - start >= timeout:
+                    self._stats[_STAT_DROPPED] += 1
+                    return None
+                time.sleep(0.001)
+
+        # until it is published the slot belongs to the producer, and can't be acquired again
+        self._states[slot] = SLOT_WRITING
+        self._next_slot = (slot + 1) % self.slot_count
+        return slot
+
+    def frame(self, slot: int) -> np.ndarray:
+        return self._frames[slot]
+
+    def publish(self, slot: int, boxes: Optional[list[tuple[int, int, int, int]]] = None, timestamp: float = 0):
+        self._timestamps[slot] = timestamp
+        count = 0
+        if boxes:
+            count = min(len(boxes), MAX_BOXES)
+            self._boxes[slot, :count] = boxes[:count]
+        self._box_counts[slot] = count
+        self._states[slot] = SLOT_READY
+        self._stats[_STAT_WRITTEN] += 1
+        self._stats[_STAT_LAST_SLOT] = slot
+
+    def release(self, slot: int):
+        self._states[slot] = SLOT_FREE
+
+    def boxes(self, slot: int) -> np.ndarray:
+        return self._boxes[slot, :self._box_counts[slot]]
+
+    def timestamp(self, slot: int) -> float:
+        # in seconds, see FrameReader for what they are relative to
+        return float(self._timestamps[slot])
+
+    @property
+    def last_slot(self):
+        # most recently published slot
+        return int(self._stats[_STAT_LAST_SLOT])
+
+    @property
+    def written(self):
+        return int(self._stats[_STAT_WRITTEN])
+
+    @property
+    def dropped(self):
+        return int(self._stats[_STAT_DROPPED])
+
+    @property
+    def in_use(self):
+        return int(np.count_nonzero(self._states))
+
+    def wait_until_drained(self, timeout: float):
+        start = time.monotonic()
+        while self.in_use != 0:
+            if time.monotonic() - start >= timeout:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self):
+        # views into the buffer must be dropped before the shared memory can be closed
+        del self._states
+        del self._stats
+        del self._box_counts
+        del self._boxes
+        del self._timestamps
+        del self._frames
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def _align(size: int, alignment: int = 8):
+    return (size + alignment - 1) // alignment * alignment
@@ -2,11 +2,23 @@ import argparse
 import multiprocessing
 import os
 from pathlib import Path
+import signal
+import threading
 
 import cv2
 
+from background_models import BACKGROUND_MODELS
+from bs_morphology_solver import SOLVERS, create_solver
 import clip_manager
-from capture import capture
+import compressor
+import crops
+import dvr
+import metrics
+import motion_gate
+import upload_spool
+from capture import DETECTION_WIDTH, capture
+import supervisor
+from zones import DetectionZones
 
 
 if __name__ == "__main__":
@@ -17,27 +29,90 @@ if __name__ == "__main__":
                         help="capture device")
     parser.add_argument("-f", "--file", type=str,
                         help="Path to video file, useful for testing purposes")
+    parser.add_argument("--config", type=str,
+                        help="Path to a JSON file listing several cameras to run at once, see supervisor.load_config")
+    parser.add_argument("--headless", action="store_true",
+                        help="Don't show any windows, stop with ctrl+c or SIGTERM. Use debug_viewer.py to watch the camera")
+    parser.add_argument("--solver", default="fast", choices=SOLVERS,
+                        help="fast: solver that reuses its buffers between frames. reference: original solver, produces the same contours")
+    parser.add_argument("--background", default="average", choices=BACKGROUND_MODELS,
+                        help="static: first frame is the background. average: running average of the background, follows lighting changes. mog2/knn: OpenCV background subtractors")
+    parser.add_argument("--no-motion-gate", action="store_true",
+                        help="Run the solver on every frame, instead of skipping frames while nothing is changing")
+    parser.add_argument("--gate-threshold", type=int, default=motion_gate.PIXEL_THRESHOLD,
+                        help="Change in brightness of part of the frame that counts as activity for the motion gate")
+    parser.add_argument("--gate-interval", type=int, default=motion_gate.IDLE_INTERVAL,
+                        help="While nothing is changing, the solver still runs on every nth frame")
+    parser.add_argument("--detection-width", type=int, default=DETECTION_WIDTH,
+                        help="Width frames are downscaled to for motion detection, clips are still recorded at up to 1280px wide")
+    parser.add_argument("--zones", type=str,
+                        help="JSON file of polygons motion is detected in (include) and ignored in (exclude), see zones.py")
+    parser.add_argument("--pre-roll", type=float, default=clip_manager.PRE_ROLL_DURATION,
+                        help="Seconds of video from before motion was detected to include at the start of each clip")
+    parser.add_argument("--clip-mode", default=clip_manager.CLIP_MODE_FIXED, choices=clip_manager.CLIP_MODES,
+                        help="fixed: cut clips every 10 seconds while there is motion. event: one clip per event, extended while motion continues")
+    parser.add_argument("--post-roll", type=float, default=clip_manager.POST_ROLL_DURATION,
+                        help="Event mode: seconds of video to keep after motion has stopped")
+    parser.add_argument("--merge-gap", type=float, default=clip_manager.MERGE_GAP_DURATION,
+                        help="Event mode: events separated by at most this many seconds after the post-roll are recorded as one clip")
+    parser.add_argument("--max-clip-duration", type=float, default=clip_manager.MAX_CLIP_DURATION,
+                        help="Event mode: longest clip in seconds, longer events are split")
+    parser.add_argument("--encoder", default=clip_manager.ENCODER_PIPE, choices=clip_manager.ENCODERS,
+                        help="pipe: encode frames straight to H.264 with ffmpeg. xvid: write an XVID .avi and compress it afterwards. dvr: record every frame into segments on disk and cut clips out of them without encoding again")
+    parser.add_argument("--dvr-segment", type=float, default=dvr.DVR_SEGMENT_DURATION,
+                        help="DVR encoder: length of each segment in seconds, clips are ready this long after they end at the latest")
+    parser.add_argument("--dvr-max-mb", type=int, default=dvr.DVR_MAX_BYTES // (1024 * 1024),
+                        help="DVR encoder: disk space the segments of each camera can use before the oldest are removed")
+    parser.add_argument("-c", "--compression", metavar="Compression level", default="m", choices=["h", "m", "l"],
+                        help="Compression level of the saved clips, h (high), m (medium) or l (low)")
+    parser.add_argument("--profile", default=compressor.DEFAULT_PROFILE, choices=list(compressor.PROFILES),
+                        help="Encoding profile of the saved clips, see compressor.PROFILES. adaptive uses faster presets while other clips are encoding")
+    parser.add_argument("--crf", type=int,
+                        help="Constant rate factor of the saved clips, overrides --compression")
+    parser.add_argument("--crops", type=int, default=crops.CROP_COUNT,
+                        help="Number of crops of the best detections uploaded with each clip for the server to classify, 0 for none")
+    parser.add_argument("--workers", type=int, default=clip_manager.CLIP_WORKERS,
+                        help="Number of clips that can be compressed at the same time")
+    parser.add_argument("--spool-max-mb", type=int, default=upload_spool.SPOOL_MAX_BYTES // (1024 * 1024),
+                        help="Disk space clips waiting to be uploaded can use before the oldest are removed")
+    parser.add_argument("--upload-concurrency", type=int, default=upload_spool.UPLOAD_CONCURRENCY,
+                        help="Number of clips that can be uploaded at the same time")
+    parser.add_argument("--metrics-dir", type=str,
+                        help="Write timings and counters of every process to JSON files in this directory every few seconds")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve the metrics of every process in the Prometheus text format on http://127.0.0.1:<port>/metrics")
     args = parser.parse_args(sys.argv[1:])
 
     filepath = args.file
     device = args.device
 
-    if filepath is None and device is None:
-        print("Error: file path or device must be specified")
+    sources = [s for s in [filepath, device, args.config] if s is not None]
+    if len(sources) == 0:
+        print("Error: file path, device or config must be specified")
         exit(1)
-    elif filepath is not None and device is not None:
-        print("Error: Only one of filepath or device can be specified")
+    elif len(sources) > 1:
+        print("Error: Only one of filepath, device or config can be specified")
         exit(1)
 
+    cameras: list[supervisor.CameraConfig] = []
     video: cv2.VideoCapture = None  # type: ignore
-    if filepath is not None:
-        video = cv2.VideoCapture(str(Path(filepath).resolve()))
-    if device is not None:
-        video = cv2.VideoCapture(int(device))
+    if args.config is not None:
+        cameras = supervisor.load_config(args.config)
+    else:
+        if filepath is not None:
+            video = cv2.VideoCapture(str(Path(filepath).resolve()))
+        if device is not None:
+            video = cv2.VideoCapture(int(device))
 
-    if not video.isOpened():
-        print("Could not open video device or file.")
-        exit(1)
+        if not video.isOpened():
+            print("Could not open video device or file.")
+            exit(1)
+
+    if args.metrics_dir is not None or args.metrics_port is not None:
+        # must be enabled before any other process is started
+        metrics.enable(args.metrics_dir or "./metrics")
+        if args.metrics_port is not None:
+            metrics.serve(args.metrics_port)
 
     queue = multiprocessing.Queue()
 
@@ -45,5 +120,31 @@ if __name__ == "__main__":
     if not out_dir.exists():
         os.mkdir(out_dir)
 
-    clip_manager.start_processing(queue, out_dir)
-    capture(video, queue)
+    crf = args.crf
+    if crf is None:
+        crf = compressor.map_compression_level_to_crf(args.compression)
+    settings = clip_manager.ClipSettings(
+        pre_roll_duration=args.pre_roll, encoder=args.encoder, crf=crf, workers=args.workers,
+        spool_max_bytes=args.spool_max_mb * 1024 * 1024, upload_concurrency=args.upload_concurrency, mode=args.clip_mode,
+        post_roll_duration=args.post_roll, merge_gap=args.merge_gap, max_duration=args.max_clip_duration, profile=args.profile,
+        camera_profiles={c.id: c.profile for c in cameras if c.profile is not None},
+        dvr_segment_duration=args.dvr_segment, dvr_max_bytes=args.dvr_max_mb * 1024 * 1024, crop_count=args.crops)
+    clip_manager.start_processing(queue, out_dir, settings)
+    if args.config is not None:
+        try:
+            supervisor.CameraSupervisor(cameras, queue).run()
+        finally:
+            clip_manager.stop_processing(queue)
+        exit(0)
+
+    solver = create_solver(args.solver, args.background)
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    try:
+        capture(video, queue, live=device is not None,
+                solver=solver, detection_width=args.detection_width, stop=stop, headless=args.headless,
+                motion_gate=None if args.no_motion_gate else motion_gate.MotionGate(args.gate_threshold, idle_interval=args.gate_interval),
+                zones=DetectionZones.load(args.zones) if args.zones is not None else None)
+    finally:
+        clip_manager.stop_processing(queue)
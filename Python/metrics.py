@@ -0,0 +1,233 @@
+import atexit
+import bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from pathlib import Path
+import re
+import threading
+import time
+
+# Metrics are kept per process, and each process writes them to a JSON file in the metrics directory every
+# METRICS_INTERVAL_S seconds. serve() exposes the files of every process in the Prometheus text format.
+# Until start_process() is called with metrics enabled every function here returns immediately.
+
+METRICS_INTERVAL_S = 10
+# the directory is passed to child processes through the environment, so that it works with any start method
+METRICS_DIR_ENV = "CAMERA_METRICS_DIR"
+# upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+_enabled = False
+_process_name = ""
+_path: Path = None  # type: ignore
+_lock = threading.Lock()
+_counters: dict[str, float] = {}
+_gauges: dict[str, float] = {}
+_histograms: dict[str, "_Histogram"] = {}
+
+
+def _after_fork():
+    # the dump thread of the parent may have held the lock when it forked, and it doesn't exist in the child to
+    # release it
+    global _lock
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+class _Histogram():
+    def __init__(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer():
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        observe(self.name, time.perf_counter() - self.start)
+
+
+class _NoopTimer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+def enabled():
+    return _enabled
+
+
+def enable(metrics_dir: os.PathLike):
+    # called once by the main process, before any other process is started
+    metrics_dir = Path(metrics_dir)
+    metrics_dir.mkdir(parents=True, exist_ok=True)
+    for path in metrics_dir.glob("*.json"):
+        os.remove(path)
+    os.environ[METRICS_DIR_ENV] = str(metrics_dir.resolve())
+
+
+def start_process(name: str):
+    # called at the start of every process that records metrics, forked processes start with an empty registry
+    global _enabled, _process_name, _path
+    metrics_dir = os.getenv(METRICS_DIR_ENV)
+    if metrics_dir is None:
+        return
+
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+    _process_name = name
+    _enabled = True
+    _path = Path(metrics_dir).joinpath(
+        f"{re.sub(r'[^A-Za-z0-9_.-]', '_', name)}-{os.getpid()}.json")
+    threading.Thread(target=_dump_periodically, daemon=True).start()
+    atexit.register(flush)
+
+
+def flush():
+    # multiprocessing children exit without running atexit, so processes call this before they end
+    if _enabled:
+        _dump(_path)
+
+
+def timed(name: str):
+    # with metrics.timed("stage"): ... records the duration of the block in the "stage" histogram
+    if not _enabled:
+        return _NOOP_TIMER
+    return _Timer(name)
+
+
+def observe(name: str, seconds: float):
+    if not _enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = _Histogram()
+        histogram.observe(seconds)
+
+
+def increment(name: str, value: float = 1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name: str, value: float):
+    if not _enabled:
+        return
+    _gauges[name] = value
+
+
+def snapshot():
+    with _lock:
+        return {
+            "process": _process_name,
+            "pid": os.getpid(),
+            "time": time.time(),
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "histograms": {name: {"counts": list(h.counts), "sum": h.sum, "count": h.count} for (name, h) in _histograms.items()},
+        }
+
+
+def _dump(path: Path):
+    try:
+        temp_path = path.with_suffix(".tmp")
+        with open(temp_path, "w") as f:
+            json.dump(snapshot(), f)
+        os.replace(temp_path, path)
+    except OSError:
+        print(f"Could not write metrics to {path}")
+
+
+def _dump_periodically():
+    while True:
+        _dump(_path)
+        time.sleep(METRICS_INTERVAL_S)
+
+
+def _format_value(value: float):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def to_prometheus(snapshots: list[dict]):
+    lines: list[str] = []
+    for s in snapshots:
+        labels = f'process="{s["process"]}",pid="{s["pid"]}"'
+        for (name, value) in s["counters"].items():
+            lines.append(f"camera_{name}_total{{{labels}}} {_format_value(value)}")
+        for (name, value) in s["gauges"].items():
+            lines.append(f"camera_{name}{{{labels}}} {_format_value(value)}")
+        for (name, h) in s["histograms"].items():
+            cumulative = 0
+            for (bound, count) in zip(LATENCY_BUCKETS + ["+Inf"], h["counts"]):
+                cumulative += count
+                lines.append(
+                    f'camera_{name}_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"camera_{name}_seconds_sum{{{labels}}} {h['sum']!r}")
+            lines.append(f"camera_{name}_seconds_count{{{labels}}} {h['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def read_snapshots(metrics_dir: os.PathLike):
+    # files that have not been written for a while belong to processes that have exited
+    snapshots = []
+    for path in Path(metrics_dir).glob("*.json"):
+        try:
+            if time.time() - path.stat().st_mtime > 3 * METRICS_INTERVAL_S:
+                continue
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def serve(port: int, host: str = "127.0.0.1"):
+    # serves /metrics in the Prometheus text format from a background thread
+    metrics_dir = os.getenv(METRICS_DIR_ENV)
+    if metrics_dir is None:
+        raise Exception("metrics.enable() must be called before serve()")
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = to_prometheus(read_snapshots(metrics_dir)).encode()  # type: ignore
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
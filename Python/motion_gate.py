@@ -0,0 +1,85 @@
+from typing import Optional
+import cv2
+import numpy as np
+
+# width of the thumbnail frames are compared at, each thumbnail pixel is the mean of a block of the frame
+THUMBNAIL_WIDTH = 32
+# change in a thumbnail pixel that counts as activity. Block means average out most sensor noise, so this can be
+# much lower than the solver's threshold
+PIXEL_THRESHOLD = 6
+# frames solved at full rate after activity was last seen
+HOLD_FRAMES = 30
+# while nothing is changing the solver still runs on every nth frame, so the background model keeps up and slow
+# changes are still seen
+IDLE_INTERVAL = 5
+
+
+# Cheap first stage in front of the solver. Each frame is shrunk to a small greyscale thumbnail and compared with
+# the thumbnail of the last solved frame, and the solver is skipped while nothing has changed and no motion has been
+# found recently.
+class MotionGate():
+    def __init__(self, pixel_threshold=PIXEL_THRESHOLD, hold_frames=HOLD_FRAMES, idle_interval=IDLE_INTERVAL, thumbnail_width=THUMBNAIL_WIDTH) -> None:
+        self.pixel_threshold = pixel_threshold
+        self.hold_frames = hold_frames
+        self.idle_interval = max(1, idle_interval)
+        self.thumbnail_width = thumbnail_width
+        self._shape: Optional[tuple[int, int]] = None
+        self._reference: Optional[np.ndarray] = None
+        self._hold = 0
+        self._since_solve = 0
+        self.solved = 0
+        self.skipped = 0
+
+    def _allocate(self, shape: tuple[int, int]):
+        self._shape = shape
+        (height, width) = shape
+        thumbnail_width = min(self.thumbnail_width, width)
+        self._size = (thumbnail_width, max(
+            1, int(round(height * thumbnail_width / width))))
+        self._thumbnail = np.empty((self._size[1], self._size[0], 3), np.uint8)
+        self._greyscale = np.empty((self._size[1], self._size[0]), np.uint8)
+        self._difference = np.empty_like(self._greyscale)
+        self._reference = None
+
+    @property
+    def skip_ratio(self):
+        total = self.solved + self.skipped
+        return self.skipped / total if total != 0 else 0
+
+    def should_solve(self, frame: np.ndarray):
+        shape = (frame.shape[0], frame.shape[1])
+        if self._shape != shape:
+            self._allocate(shape)
+
+        cv2.resize(frame, self._size, dst=self._thumbnail,
+                   interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._thumbnail, cv2.COLOR_BGR2GRAY, dst=self._greyscale)
+
+        solve = self._reference is None or self._hold > 0 or self._since_solve + 1 >= self.idle_interval
+        if not solve:
+            cv2.absdiff(self._reference, self._greyscale,  # type: ignore
+                        dst=self._difference)
+            (_, max_difference, _, _) = cv2.minMaxLoc(self._difference)
+            if max_difference > self.pixel_threshold:
+                solve = True
+                self._hold = self.hold_frames
+
+        if not solve:
+            self._since_solve += 1
+            self.skipped += 1
+            return False
+
+        if self._reference is None:
+            self._reference = self._greyscale.copy()
+        else:
+            np.copyto(self._reference, self._greyscale)
+        self._since_solve = 0
+        self.solved += 1
+        return True
+
+    def update(self, motion_found: bool):
+        # called with the result of every frame that was solved
+        if motion_found:
+            self._hold = self.hold_frames
+        elif self._hold > 0:
+            self._hold -= 1
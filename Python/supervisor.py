@@ -0,0 +1,193 @@
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import signal
+import time
+import traceback
+from typing import Optional
+import cv2
+from bs_morphology_solver import create_solver
+from capture import DETECTION_WIDTH, capture
+import compressor
+from motion_gate import MotionGate
+from zones import DetectionZones
+
+# delay before a failed camera is restarted, doubled for every failure in a row
+RESTART_DELAY_S = 1
+RESTART_DELAY_MAX_S = 60
+# a camera that ran for at least this long before failing is restarted without waiting
+HEALTHY_RUN_S = 60
+
+
+class CameraConfig():
+    def __init__(self, id: str, source: str | int, live: bool, solver: str = "fast", background: str = "average",
+                 detection_width: int = DETECTION_WIDTH, cpus: Optional[list[int]] = None, headless: bool = True,
+                 motion_gate: bool = True, profile: Optional[str] = None, zones: Optional[DetectionZones] = None) -> None:
+        self.id = id
+        self.source = source
+        self.live = live
+        self.solver = solver
+        self.background = background
+        self.detection_width = detection_width
+        self.cpus = cpus
+        self.headless = headless
+        self.motion_gate = motion_gate
+        # encoding profile of this camera's clips, the --profile argument is used when there isn't one
+        self.profile = profile
+        self.zones = zones
+
+    @staticmethod
+    def from_json(index: int, data: dict, headless: bool = True):
+        # one of "device" (index of a capture device), "url" (network stream) or "file"
+        if "device" in data:
+            source, live = int(data["device"]), True
+        elif "url" in data:
+            source, live = str(data["url"]), True
+        elif "file" in data:
+            source, live = str(Path(data["file"]).resolve()), False
+        else:
+            raise Exception(
+                f"Camera {index} must have one of device, url or file")
+
+        profile = data.get("profile")
+        if profile is not None and profile not in compressor.PROFILES:
+            raise Exception(
+                f"Camera {index} has an unknown profile {profile}, expected one of {', '.join(compressor.PROFILES)}")
+
+        cpus = data.get("cpus")
+        if isinstance(cpus, int):
+            cpus = [cpus]
+        return CameraConfig(str(data.get("id", index)), source, live, data.get("solver", "fast"), data.get("background", "average"),
+                            int(data.get("detection_width", DETECTION_WIDTH)), cpus, bool(data.get("headless", headless)),
+                            bool(data.get("motion_gate", True)), profile,
+                            DetectionZones.from_json(data["zones"]) if "zones" in data else None)
+
+
+# Config file format:
+# {
+#   "pin_cpus": true,
+#   "headless": true,
+#   "cameras": [
+#     { "id": "hallway", "device": 0, "background": "mog2", "cpus": [2], "profile": "low-cpu" },
+#     { "id": "door", "url": "rtsp://camera/stream", "detection_width": 480,
+#       "zones": { "exclude": [[[0.8, 0], [1, 0], [1, 0.1], [0.8, 0.1]]] } },
+#     { "id": "test", "file": "video.mp4", "motion_gate": false }
+#   ]
+# }
+# Cameras without "cpus" are spread over the available cores when pin_cpus is true (the default). Cameras are
+# headless unless "headless" is false, either for every camera or for a single one.
+def load_config(path: os.PathLike) -> list[CameraConfig]:
+    with open(path) as f:
+        config = json.load(f)
+
+    headless = bool(config.get("headless", True))
+    cameras = [CameraConfig.from_json(i, c, headless)
+               for (i, c) in enumerate(config["cameras"])]
+    ids = [c.id for c in cameras]
+    if len(set(ids)) != len(ids):
+        raise Exception("Camera ids must be unique")
+
+    if config.get("pin_cpus", True) and hasattr(os, "sched_getaffinity"):
+        available = sorted(os.sched_getaffinity(0))
+        for (i, camera) in enumerate(cameras):
+            if camera.cpus is None:
+                camera.cpus = [available[i % len(available)]]
+    return cameras
+
+
+def _run_camera(camera: CameraConfig, queue: multiprocessing.Queue, stop):
+    # ctrl+c and SIGTERM are handled by the supervisor, which stops every camera through the stop event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if camera.cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, camera.cpus)
+        # otherwise OpenCV starts a thread per core of the machine in every camera process
+        cv2.setNumThreads(len(camera.cpus))
+
+    video = cv2.VideoCapture(camera.source)
+    if not video.isOpened():
+        print(f"{camera.id}: could not open {camera.source}")
+        exit(1)
+
+    solver = create_solver(camera.solver, camera.background)
+    capture(video, queue, live=camera.live, solver=solver,
+            detection_width=camera.detection_width, camera_id=camera.id, stop=stop, headless=camera.headless,
+            motion_gate=MotionGate() if camera.motion_gate else None, zones=camera.zones)
+
+
+class _CameraProcess():
+    def __init__(self, camera: CameraConfig) -> None:
+        self.camera = camera
+        self.process: Optional[multiprocessing.Process] = None
+        self.started_at = 0.0
+        self.failures = 0
+        self.restart_at = 0.0
+        self.done = False
+
+
+# Runs one capture process per camera, all sending frames to the same ClipManager through queue. Cameras that
+# exit are restarted with a backoff, except files that reached the end.
+class CameraSupervisor():
+    def __init__(self, cameras: list[CameraConfig], queue: multiprocessing.Queue) -> None:
+        self._cameras = [_CameraProcess(c) for c in cameras]
+        self._queue = queue
+        self._stop = multiprocessing.Event()
+
+    def _start(self, camera: _CameraProcess):
+        print(f"Starting camera {camera.camera.id}")
+        camera.process = multiprocessing.Process(
+            target=_run_camera, args=(camera.camera, self._queue, self._stop))
+        camera.started_at = time.time()
+        camera.process.start()
+
+    def _check(self, camera: _CameraProcess):
+        if camera.done:
+            return
+
+        if camera.process is None:
+            if time.time() >= camera.restart_at:
+                self._start(camera)
+            return
+
+        if camera.process.is_alive():
+            return
+
+        exitcode = camera.process.exitcode
+        camera.process = None
+        if exitcode == 0 and not camera.camera.live:
+            print(f"Camera {camera.camera.id} finished")
+            camera.done = True
+            return
+
+        if time.time() - camera.started_at >= HEALTHY_RUN_S:
+            camera.failures = 0
+        delay = 0 if camera.failures == 0 else min(
+            RESTART_DELAY_S * 2 ** (camera.failures - 1), RESTART_DELAY_MAX_S)
+        camera.failures += 1
+        camera.restart_at = time.time() + delay
+        print(
+            f"Camera {camera.camera.id} exited with code {exitcode}, restarting in {delay}s")
+
+    def run(self):
+        # returns once every camera has finished, stop() was called or the process was asked to stop by a signal
+        signal.signal(signal.SIGTERM, lambda *_: self._stop.set())
+        try:
+            while not self._stop.is_set() and not all(c.done for c in self._cameras):
+                for camera in self._cameras:
+                    try:
+                        self._check(camera)
+                    except Exception:
+                        print(traceback.format_exc())
+                self._stop.wait(1)
+        except KeyboardInterrupt:
+            print("Stopping cameras")
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._stop.set()
+        for camera in self._cameras:
+            if camera.process is not None:
+                camera.process.join()
+                camera.process = None
@@ -0,0 +1,207 @@
+import datetime
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import uuid
+import requests
+import api
+
+# Checks ClipsApi.upload_clip against a stub of the Web API's /clips/uploads endpoints:
+#   python -m unittest test_upload
+
+CHUNK_SIZE = 1000
+
+
+class StubUploadServer(ThreadingHTTPServer):
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), StubUploadHandler)
+        self.uploads: dict[str, bytes] = {}
+        self.completed: dict[str, bytes] = {}
+        # (upload id, start of the range) of every PUT
+        self.puts: list[tuple[str, int]] = []
+        # numbers of the PUTs (counted from 0) and GETs that fail with a 500
+        self.failing_puts: set[int] = set()
+        self.failing_gets = 0
+        self.lock = threading.Lock()
+
+    @property
+    def host(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+class StubUploadHandler(BaseHTTPRequestHandler):
+    server: StubUploadServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status: int, body=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def upload_id(self):
+        # /clips/uploads/{id} or /clips/uploads/{id}/complete
+        return self.path.split("/")[3]
+
+    def do_POST(self):
+        body = self.read_body()
+        with self.server.lock:
+            if self.path == "/clips/uploads":
+                upload_id = str(uuid.uuid4())
+                self.server.uploads[upload_id] = b""
+                return self.reply(200, {"id": upload_id, "offset": 0})
+            upload_id = self.upload_id()
+            if upload_id not in self.server.uploads:
+                return self.reply(404)
+            json.loads(body)
+            self.server.completed[upload_id] = self.server.uploads.pop(
+                upload_id)
+            self.reply(200)
+
+    def do_GET(self):
+        with self.server.lock:
+            if self.server.failing_gets > 0:
+                self.server.failing_gets -= 1
+                return self.reply(500)
+            upload_id = self.upload_id()
+            if upload_id not in self.server.uploads:
+                return self.reply(404)
+            self.reply(200, {"id": upload_id, "offset": len(
+                self.server.uploads[upload_id])})
+
+    def do_DELETE(self):
+        with self.server.lock:
+            self.server.uploads.pop(self.upload_id(), None)
+            self.reply(204)
+
+    def do_PUT(self):
+        body = self.read_body()
+        with self.server.lock:
+            upload_id = self.upload_id()
+            if upload_id not in self.server.uploads:
+                return self.reply(404)
+            # "bytes {start}-{end}/{size}"
+            start = int(self.headers["Content-Range"].split()[1].split("-")[0])
+            self.server.puts.append((upload_id, start))
+            if len(self.server.puts) - 1 in self.server.failing_puts:
+                return self.reply(500)
+            received = self.server.uploads[upload_id]
+            if start != len(received):
+                return self.reply(409, {"id": upload_id, "offset": len(received)})
+            self.server.uploads[upload_id] = received + body
+            self.reply(200, {"id": upload_id, "offset": len(
+                self.server.uploads[upload_id])})
+
+
+class UploadClipTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = StubUploadServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.clip_path = Path(directory.name).joinpath("clip.mp4")
+        self.clip = os.urandom(4500)
+        self.clip_path.write_bytes(self.clip)
+
+        for patch in [mock.patch.object(api, "UPLOAD_CHUNK_SIZE", CHUNK_SIZE),
+                      mock.patch.object(api, "UPLOAD_RETRIES", 1),
+                      mock.patch.object(api.time, "sleep")]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.api = api.ClipsApi(self.server.host)
+        self.addCleanup(self.api.session.close)
+        self.progress: list[tuple[str, int]] = []
+
+    def upload(self, upload_id=None, offset=0):
+        self.api.upload_clip(datetime.datetime(2024, 1, 1), self.clip_path, [{"timestamp": 0, "boundingBox": [1, 2, 3, 4]}],
+                             upload_id=upload_id, offset=offset,
+                             progress=lambda u, o: self.progress.append((u, o)))
+
+    def start_upload(self, received: int):
+        # an upload the API already has the first `received` bytes of
+        upload_id = str(uuid.uuid4())
+        self.server.uploads[upload_id] = self.clip[:received]
+        return upload_id
+
+    def test_upload_in_chunks(self):
+        self.upload()
+
+        self.assertEqual(list(self.server.completed.values()), [self.clip])
+        self.assertEqual([start for (_, start) in self.server.puts], [
+                         0, 1000, 2000, 3000, 4000])
+        self.assertEqual(self.progress[-1][1], len(self.clip))
+
+    def test_failed_chunk_resumes_from_server_offset(self):
+        self.server.failing_puts = {2}
+        self.upload()
+
+        self.assertEqual(list(self.server.completed.values()), [self.clip])
+        # the failed chunk is sent again, nothing before it is
+        self.assertEqual([start for (_, start) in self.server.puts], [
+                         0, 1000, 2000, 2000, 3000, 4000])
+
+    def test_too_many_failures_keep_the_upload(self):
+        self.server.failing_puts = {2, 3}
+        with self.assertRaises(requests.HTTPError):
+            self.upload()
+
+        self.assertEqual(self.server.completed, {})
+        (upload_id, offset) = self.progress[-1]
+        self.assertEqual(offset, 2000)
+        self.assertEqual(len(self.server.uploads[upload_id]), 2000)
+
+        # a later attempt carries on from where the first one got to
+        self.server.failing_puts.clear()
+        self.server.puts.clear()
+        self.upload(upload_id, offset)
+        self.assertEqual(self.server.completed, {upload_id: self.clip})
+        self.assertEqual([start for (_, start) in self.server.puts], [
+                         2000, 3000, 4000])
+
+    def test_resume_from_server_offset(self):
+        # the API received more than was stored before the last attempt stopped
+        upload_id = self.start_upload(3000)
+        self.upload(upload_id, 1000)
+
+        self.assertEqual(self.server.completed, {upload_id: self.clip})
+        self.assertEqual(self.server.puts, [(upload_id, 3000), (upload_id, 4000)])
+
+    def test_conflict_continues_from_server_offset(self):
+        # the API can't be asked for its offset, so the first chunk is sent from the stored one and rejected
+        upload_id = self.start_upload(3000)
+        self.server.failing_gets = 1
+        self.upload(upload_id, 1000)
+
+        self.assertEqual(self.server.completed, {upload_id: self.clip})
+        self.assertEqual(self.server.puts, [
+                         (upload_id, 1000), (upload_id, 3000), (upload_id, 4000)])
+        self.assertIn((upload_id, 3000), self.progress)
+
+    def test_expired_upload_starts_again(self):
+        expired = str(uuid.uuid4())
+        self.upload(expired, 2000)
+
+        self.assertNotIn(expired, self.server.completed)
+        self.assertEqual(list(self.server.completed.values()), [self.clip])
+        self.assertEqual(self.server.puts[0][1], 0)
+        self.assertEqual(self.progress[0][1], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
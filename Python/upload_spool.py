@@ -0,0 +1,219 @@
+from contextlib import closing
+import datetime
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import shutil
+import sqlite3
+import threading
+import time
+import traceback
+from typing import Optional
+from api import ClipsApi, DetectionData
+from crops import CropData
+import metrics
+
+SPOOL_MAX_BYTES = 2 * 1024 * 1024 * 1024
+UPLOAD_CONCURRENCY = 2
+RETRY_BACKOFF_BASE_S = 5
+RETRY_BACKOFF_MAX_S = 10 * 60
+
+
+# columns added after the spool was first released, and their definitions, for spools created before them
+ADDED_COLUMNS = {
+    "crops": "TEXT NOT NULL DEFAULT '[]'",
+    "upload_id": "TEXT",
+    "upload_offset": "INTEGER NOT NULL DEFAULT 0",
+}
+
+
+class SpoolEntry():
+    def __init__(self, id: int, path: Path, date_recorded: datetime.datetime, detection_data: DetectionData, attempts: int,
+                 crop_data: Optional[CropData] = None, upload_id: Optional[str] = None, upload_offset: int = 0) -> None:
+        self.id = id
+        self.path = path
+        self.date_recorded = date_recorded
+        self.detection_data = detection_data
+        self.crop_data = crop_data or []
+        self.attempts = attempts
+        # upload started on the API by an earlier attempt, and how much of it the API had received
+        self.upload_id = upload_id
+        self.upload_offset = upload_offset
+
+
+# Directory of encoded clips waiting to be uploaded, indexed by a small SQLite database so that clips survive the
+# API being unavailable and restarts. Only paths are held here so a spool can be sent to other processes, every
+# operation opens its own connection.
+class UploadSpool():
+    def __init__(self, spool_dir: os.PathLike, max_bytes: int = SPOOL_MAX_BYTES) -> None:
+        self.spool_dir = Path(spool_dir)
+        self.max_bytes = max_bytes
+        if not self.spool_dir.exists():
+            os.makedirs(self.spool_dir)
+
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS clips (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                date_recorded TEXT NOT NULL,
+                detections TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL DEFAULT 0
+            )""")
+            columns = [row[1] for row in db.execute("PRAGMA table_info(clips)")]
+            for (column, definition) in ADDED_COLUMNS.items():
+                if column not in columns:
+                    db.execute(
+                        f"ALTER TABLE clips ADD COLUMN {column} {definition}")
+            db.commit()
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.spool_dir.joinpath("spool.db"), timeout=30))
+
+    def commit(self, clip_path: Path, date_recorded: datetime.datetime, detection_data: DetectionData, crop_data: Optional[CropData] = None):
+        # the clip is moved into the spool, and the oldest clips are evicted if the spool is over its quota
+        path = self.spool_dir.joinpath(
+            f"{int(time.time() * 1000)}_{clip_path.name}")
+        shutil.move(clip_path, path)
+        with self._connect() as db:
+            db.execute("INSERT INTO clips (path, size, date_recorded, detections, crops) VALUES (?, ?, ?, ?, ?)",
+                       (str(path), os.path.getsize(path), date_recorded.isoformat(), json.dumps(detection_data),
+                        json.dumps(crop_data or [])))
+            db.commit()
+        print(f"Spooled {path} for upload")
+        self._evict()
+
+    def _evict(self):
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT id, path, size FROM clips ORDER BY id DESC").fetchall()
+            total = 0
+            for (id, path, size) in rows:
+                total += size
+                if total <= self.max_bytes:
+                    continue
+                print(
+                    f"Upload spool is over {self.max_bytes} bytes, removing {path}")
+                db.execute("DELETE FROM clips WHERE id = ?", (id,))
+                _remove_file(path)
+            db.commit()
+
+    def next_due(self, exclude: set[int]) -> Optional[SpoolEntry]:
+        # oldest clip that isn't waiting for a retry
+        with self._connect() as db:
+            rows = db.execute("SELECT id, path, date_recorded, detections, attempts, crops, upload_id, upload_offset FROM clips WHERE next_attempt <= ? ORDER BY id",
+                              (time.time(),)).fetchall()
+        for (id, path, date_recorded, detections, attempts, crops, upload_id, upload_offset) in rows:
+            if id in exclude:
+                continue
+            return SpoolEntry(id, Path(path), datetime.datetime.fromisoformat(date_recorded), json.loads(detections), attempts,
+                              json.loads(crops), upload_id, upload_offset)
+        return None
+
+    def save_progress(self, entry: SpoolEntry, upload_id: str, offset: int):
+        # so that a retry, or the next run, carries on with the same upload instead of starting again
+        entry.upload_id = upload_id
+        entry.upload_offset = offset
+        with self._connect() as db:
+            db.execute("UPDATE clips SET upload_id = ?, upload_offset = ? WHERE id = ?",
+                       (upload_id, offset, entry.id))
+            db.commit()
+
+    def failed(self, entry: SpoolEntry):
+        delay = min(RETRY_BACKOFF_BASE_S * 2 ** entry.attempts,
+                    RETRY_BACKOFF_MAX_S)
+        with self._connect() as db:
+            db.execute("UPDATE clips SET attempts = attempts + 1, next_attempt = ? WHERE id = ?",
+                       (time.time() + delay, entry.id))
+            db.commit()
+        print(f"Upload of {entry.path} failed, retrying in {delay}s")
+
+    def remove(self, entry: SpoolEntry):
+        with self._connect() as db:
+            db.execute("DELETE FROM clips WHERE id = ?", (entry.id,))
+            db.commit()
+        _remove_file(entry.path)
+
+
+def _remove_file(path: os.PathLike):
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+    except OSError:
+        print(f"Could not remove {path}")
+
+
+# Drains the spool on a background process so that nothing else ever waits on the API
+class SpoolUploader():
+    def __init__(self, spool: UploadSpool, host: str, concurrency: int = UPLOAD_CONCURRENCY) -> None:
+        self.spool = spool
+        self.host = host
+        self.concurrency = max(1, concurrency)
+        self._stop = multiprocessing.Event()
+        self._process: Optional[multiprocessing.Process] = None
+
+    def start(self):
+        self._process = multiprocessing.Process(target=_run_uploader, args=(
+            self.spool, self.host, self.concurrency, self._stop))
+        self._process.start()
+
+    def stop(self):
+        # waits for the uploads in progress, clips that haven't started uploading stay in the spool for next time
+        self._stop.set()
+        if self._process is not None:
+            self._process.join()
+
+
+def _run_uploader(spool: UploadSpool, host: str, concurrency: int, stop):
+    metrics.start_process("uploader")
+    lock = threading.Lock()
+    in_progress: set[int] = set()
+    threads = [threading.Thread(target=_upload_loop, args=(spool, host, stop, lock, in_progress))
+               for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    metrics.flush()
+
+
+def _upload_loop(spool: UploadSpool, host: str, stop, lock: threading.Lock, in_progress: set[int]):
+    api = ClipsApi(host)
+    # once stopped, uploads in progress are finished and everything else stays in the spool for next time
+    while not stop.is_set():
+        with lock:
+            try:
+                entry = spool.next_due(in_progress)
+            except Exception:
+                print(traceback.format_exc())
+                entry = None
+            if entry is not None:
+                in_progress.add(entry.id)
+
+        if entry is None:
+            stop.wait(1)
+            continue
+
+        try:
+            if not entry.path.exists():
+                print(f"{entry.path} is missing, removing it from the spool")
+                if entry.upload_id is not None:
+                    api.delete_upload(entry.upload_id)
+            else:
+                with metrics.timed("upload"):
+                    api.upload_clip(entry.date_recorded, entry.path, entry.detection_data, entry.crop_data,
+                                    entry.upload_id, entry.upload_offset,
+                                    lambda upload_id, offset: spool.save_progress(entry, upload_id, offset))
+                metrics.increment("uploads")
+                print(f"Uploaded {entry.path}")
+            spool.remove(entry)
+        except Exception:
+            print(traceback.format_exc())
+            metrics.increment("upload_failures")
+            spool.failed(entry)
+        finally:
+            with lock:
+                in_progress.remove(entry.id)
@@ -0,0 +1,118 @@
+import heapq
+import itertools
+import multiprocessing
+from multiprocessing.connection import Connection, wait
+import traceback
+from typing import Callable, Optional
+import metrics
+
+# workers are replaced while the ClipManager has encoders running, a forked worker would inherit the write end of
+# their stdin pipes and ffmpeg would never see the end of its input. These start methods don't inherit them
+_context = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+
+def _run_worker(jobs: multiprocessing.Queue, done: Connection):
+    metrics.start_process("clip-worker")
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+
+        (job_id, target) = job
+        try:
+            with metrics.timed("job"):
+                target()
+        except Exception:
+            metrics.increment("job_failures")
+            print(traceback.format_exc())
+        metrics.flush()
+        done.send(job_id)
+
+
+# Every worker has its own queues, so the pool knows which job a worker was running if it dies, and a worker that
+# dies while writing to a queue can't leave it locked for the others
+class _Worker():
+    def __init__(self) -> None:
+        self.jobs = _context.Queue()
+        (self.done, done_writer) = _context.Pipe(duplex=False)
+        self.job_id: Optional[int] = None
+        self.process = _context.Process(
+            target=_run_worker, args=(self.jobs, done_writer))
+        self.process.start()
+        done_writer.close()
+
+    def close(self):
+        self.done.close()
+        self.jobs.close()
+        self.jobs.cancel_join_thread()
+
+
+# A fixed number of long-lived worker processes for finishing clips (compressing and uploading).
+# Jobs wait in the pool until a worker is free, the oldest (lowest priority value) first, so at most `concurrency`
+# jobs are ever running at the same time. The owner must call pump() regularly to hand out waiting jobs.
+# Workers that die are replaced, the job they were running is lost.
+class WorkerPool():
+    def __init__(self, concurrency: int) -> None:
+        self.concurrency = max(1, concurrency)
+        self._pending: list[tuple[float, int, Callable[[], None]]] = []
+        self._ids = itertools.count()
+        self._closed = False
+        self._workers = [_Worker() for _ in range(self.concurrency)]
+
+    @property
+    def backlog(self):
+        return len(self._pending) + sum(1 for w in self._workers if w.job_id is not None)
+
+    def submit(self, target: Callable[[], None], priority: float):
+        if self._closed:
+            raise Exception("Cannot submit jobs to a closed worker pool")
+
+        heapq.heappush(self._pending, (priority, next(self._ids), target))
+        self.pump()
+
+    def pump(self):
+        for (i, worker) in enumerate(self._workers):
+            try:
+                while worker.done.poll():
+                    worker.done.recv()
+                    worker.job_id = None
+            except EOFError:
+                # the worker has exited, handled below
+                pass
+
+            exitcode = worker.process.exitcode
+            if exitcode is not None:
+                if worker.job_id is not None:
+                    metrics.increment("jobs_lost")
+                    print(
+                        f"Worker {worker.process.pid} exited with code {exitcode} while running job {worker.job_id}, the job is lost. Starting a new worker")
+                else:
+                    print(
+                        f"Worker {worker.process.pid} exited with code {exitcode}. Starting a new worker")
+                worker.close()
+                self._workers[i] = _Worker()
+
+        for worker in self._workers:
+            if len(self._pending) == 0:
+                break
+            if worker.job_id is None:
+                (_, job_id, target) = heapq.heappop(self._pending)
+                worker.jobs.put((job_id, target))
+                worker.job_id = job_id
+
+    def drain(self):
+        # runs every job that has been submitted, then stops the workers
+        self._closed = True
+        self.pump()
+        while self.backlog != 0:
+            # wakes up when a job is done or a worker exits
+            wait([w.done for w in self._workers] +
+                 [w.process.sentinel for w in self._workers], timeout=1)
+            self.pump()
+
+        for w in self._workers:
+            w.jobs.put(None)
+        for w in self._workers:
+            w.process.join()
+            w.close()
@@ -0,0 +1,64 @@
+import json
+import os
+from typing import Optional
+import cv2
+import numpy as np
+
+Polygon = list[tuple[float, float]]
+
+
+# Areas of a camera's view that motion is detected in. Polygons are in coordinates relative to the frame, from (0, 0)
+# at the top left to (1, 1) at the bottom right, so that they don't depend on the size frames are processed at:
+#   {"include": [[[0, 0.3], [1, 0.3], [1, 1], [0, 1]]], "exclude": [[[0.8, 0], [1, 0], [1, 0.1], [0.8, 0.1]]]}
+# Motion is only detected inside the include polygons (anywhere when there are none) and outside every exclude
+# polygon. Masks are rasterized once for each frame size.
+class DetectionZones():
+    def __init__(self, include: Optional[list[Polygon]] = None, exclude: Optional[list[Polygon]] = None) -> None:
+        self.include = include or []
+        self.exclude = exclude or []
+        for polygon in self.include + self.exclude:
+            if len(polygon) < 3:
+                raise Exception(
+                    f"Zone polygons need at least 3 points, got {polygon}")
+        self._masks: dict[tuple[int, int], np.ndarray] = {}
+
+    @staticmethod
+    def from_json(data: dict):
+        return DetectionZones(data.get("include"), data.get("exclude"))
+
+    @staticmethod
+    def load(path: os.PathLike):
+        with open(path) as f:
+            return DetectionZones.from_json(json.load(f))
+
+    def _points(self, polygon: Polygon, size: tuple[int, int]):
+        return np.rint(np.array(polygon, np.float64) * size).astype(np.int32)
+
+    def mask(self, size: tuple[int, int]) -> np.ndarray:
+        # 255 where motion is detected, for frames of size (width, height)
+        mask = self._masks.get(size)
+        if mask is None:
+            (width, height) = size
+            if len(self.include) == 0:
+                mask = np.full((height, width), 255, np.uint8)
+            else:
+                mask = np.zeros((height, width), np.uint8)
+                cv2.fillPoly(mask, [self._points(p, size)
+                             for p in self.include], 255)
+            if len(self.exclude) != 0:
+                cv2.fillPoly(mask, [self._points(p, size)
+                             for p in self.exclude], 0)
+            mask = self._masks[size] = mask
+        return mask
+
+    def region(self, size: tuple[int, int]) -> tuple[tuple[int, int, int, int], Optional[np.ndarray]]:
+        # bounding box (x, y, w, h) of the zones, and the mask cropped to it. The mask is None when every pixel in
+        # the box is part of the zones, so that nothing has to be masked
+        mask = self.mask(size)
+        (x, y, w, h) = cv2.boundingRect(mask)
+        if w == 0 or h == 0:
+            raise Exception("The detection zones don't include any of the frame")
+        cropped = mask[y:y + h, x:x + w]
+        if cv2.countNonZero(cropped) == w * h:
+            return ((x, y, w, h), None)
+        return ((x, y, w, h), np.ascontiguousarray(cropped))
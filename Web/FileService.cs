@@ -26,6 +26,55 @@ public sealed class FileService
         return id;
     }
 
+    public Guid CreateUpload()
+    {
+        var id = Guid.NewGuid();
+        File.Create(GetUploadPath(id)).Dispose();
+        return id;
+    }
+
+    public long? GetUploadLength(Guid uploadId)
+    {
+        var info = new FileInfo(GetUploadPath(uploadId));
+        return info.Exists ? info.Length : null;
+    }
+
+    public async Task<long> AppendToUploadAsync(Guid uploadId, Stream data, CancellationToken cancellationToken = default)
+    {
+        await using var s = new FileStream(GetUploadPath(uploadId), FileMode.Append, FileAccess.Write);
+        await data.CopyToAsync(s, cancellationToken);
+        return s.Length;
+    }
+
+    public Guid CompleteUpload(Guid uploadId)
+    {
+        var id = Guid.NewGuid();
+        File.Move(GetUploadPath(uploadId), $"store/{id}");
+        return id;
+    }
+
+    public void DeleteUpload(Guid uploadId)
+    {
+        File.Delete(GetUploadPath(uploadId));
+    }
+
+    // uploads that haven't had a chunk written to them for longer than maxAge, the client has given up on them
+    public int DeleteStaleUploads(TimeSpan maxAge)
+    {
+        var deleted = 0;
+        foreach (var file in new DirectoryInfo("store/uploads").EnumerateFiles())
+        {
+            if (DateTime.UtcNow - file.LastWriteTimeUtc > maxAge)
+            {
+                file.Delete();
+                deleted++;
+            }
+        }
+        return deleted;
+    }
+
+    private static string GetUploadPath(Guid uploadId) => $"store/uploads/{uploadId}";
+
     public Task<Stream> GetFileAsync(Guid fileId, CancellationToken cancellationToken = default)
     {
         var path = $"store/{fileId}";
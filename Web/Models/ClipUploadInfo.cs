@@ -0,0 +1,7 @@
+﻿namespace Web.Models;
+public sealed class ClipUploadInfo
+{
+    public DateTime DateRecorded { get; init; }
+    public DetectionInfoData[] Detections { get; init; } = Array.Empty<DetectionInfoData>();
+    public CropInfoData[] Crops { get; init; } = Array.Empty<CropInfoData>();
+}
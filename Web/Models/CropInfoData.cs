@@ -0,0 +1,8 @@
+﻿namespace Web.Models;
+public sealed class CropInfoData
+{
+    public int Timestamp { get; init; }
+    public float[] BoundingBox { get; init; } = Array.Empty<float>();
+    // JPEG of the region, sent as base64
+    public byte[] Image { get; init; } = Array.Empty<byte>();
+}
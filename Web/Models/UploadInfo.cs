@@ -0,0 +1,6 @@
+﻿namespace Web.Models;
+public sealed class UploadInfo
+{
+    public Guid Id { get; init; }
+    public long Offset { get; init; }
+}
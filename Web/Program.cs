@@ -134,13 +134,54 @@ public sealed class ClipHub : Hub<IClipHub>
 
 public sealed class FileServiceStartupService : BackgroundService
 {
-    protected override Task ExecuteAsync(CancellationToken stoppingToken)
+    // uploads that have had nothing written to them for this long are deleted, the client starts a new upload if it
+    // ever comes back to one of them
+    private static readonly TimeSpan UploadExpiry = TimeSpan.FromDays(1);
+    private static readonly TimeSpan CleanupInterval = TimeSpan.FromHours(1);
+    private readonly FileService _fileService;
+    private readonly ILogger<FileServiceStartupService> _logger;
+
+    public FileServiceStartupService(FileService fileService, ILogger<FileServiceStartupService> logger)
+    {
+        _fileService = fileService;
+        _logger = logger;
+    }
+
+    protected override async Task ExecuteAsync(CancellationToken stoppingToken)
     {
         if (!Directory.Exists("store"))
         {
             Directory.CreateDirectory("store");
         }
-        return Task.CompletedTask;
+        if (!Directory.Exists("store/uploads"))
+        {
+            Directory.CreateDirectory("store/uploads");
+        }
+
+        while (!stoppingToken.IsCancellationRequested)
+        {
+            try
+            {
+                var deleted = _fileService.DeleteStaleUploads(UploadExpiry);
+                if (deleted > 0)
+                {
+                    _logger.LogInformation("Deleted {Count} stale uploads", deleted);
+                }
+            }
+            catch (Exception ex)
+            {
+                _logger.LogError(ex, "Failed to delete stale uploads.");
+            }
+
+            try
+            {
+                await Task.Delay(CleanupInterval, stoppingToken);
+            }
+            catch (OperationCanceledException)
+            {
+                break;
+            }
+        }
     }
 }
 
@@ -169,22 +210,26 @@ public sealed class NotificationsClient
     }
 }
 
+// Crops are the JPEGs the client cut out of the clip's best frames, a clip without them is classified from a frame
+// of its video
+public sealed record ImageAnalysisRequest(Guid ClipId, byte[][] Crops);
+
 public sealed class ImageAnalysisChannel
 {
-    private static readonly Channel<Guid> Channel = System.Threading.Channels.Channel.CreateUnbounded<Guid>(new UnboundedChannelOptions
+    private static readonly Channel<ImageAnalysisRequest> Channel = System.Threading.Channels.Channel.CreateUnbounded<ImageAnalysisRequest>(new UnboundedChannelOptions
     {
         SingleReader = true,
         SingleWriter = false,
     });
 
-    public ValueTask<Guid> ReadAsync(CancellationToken cancellationToken = default)
+    public ValueTask<ImageAnalysisRequest> ReadAsync(CancellationToken cancellationToken = default)
     {
         return Channel.Reader.ReadAsync(cancellationToken);
     }
 
-    public ValueTask WriteAsync(Guid clipId, CancellationToken cancellationToken = default)
+    public ValueTask WriteAsync(Guid clipId, byte[][] crops, CancellationToken cancellationToken = default)
     {
-        return Channel.Writer.WriteAsync(clipId, cancellationToken);
+        return Channel.Writer.WriteAsync(new ImageAnalysisRequest(clipId, crops), cancellationToken);
     }
 }
 
@@ -223,20 +268,24 @@ public sealed class ImageAnalysisBackgroundService : IScopedBackgroundService<Im
         {
             try
             {
-                var clipId = await _channel.ReadAsync(stoppingToken);
+                var request = await _channel.ReadAsync(stoppingToken);
+                var clipId = request.ClipId;
                 var clip = await _db.Clips
                     .Where(x => x.Id == clipId)
                     .Include(x => x.Detections)
                     .FirstAsync(stoppingToken);
 
-                var file = await _fileService.GetFileAsync(clip.FileId, stoppingToken);
-                var frameToClassify = await _videoService.GetBestCroppedFrameAsync(file, clip.Detections.Select(x => (x.BoundingBox, x.Timestamp)).ToArray());
-                var fileId = await _fileService.StoreFileAsync(frameToClassify, stoppingToken);
-
-                frameToClassify = await _fileService.GetFileAsync(fileId, stoppingToken);
-                var ms = new MemoryStream(capacity: (int)frameToClassify.Length);
-                await frameToClassify.CopyToAsync(ms, stoppingToken);
-                var classes = await _classificationService.ClassifyAsync(ms.ToArray());
+                var (image, classes) = await ClassifyCropsAsync(request.Crops);
+                if (image is null)
+                {
+                    var file = await _fileService.GetFileAsync(clip.FileId, stoppingToken);
+                    var frameToClassify = await _videoService.GetBestCroppedFrameAsync(file, clip.Detections.Select(x => (x.BoundingBox, x.Timestamp)).ToArray());
+                    var ms = new MemoryStream();
+                    await frameToClassify.CopyToAsync(ms, stoppingToken);
+                    image = ms.ToArray();
+                    classes = await _classificationService.ClassifyAsync(image);
+                }
+                var fileId = await _fileService.StoreFileAsync(image, stoppingToken);
                 Console.WriteLine($"Classifier predicted:{Environment.NewLine}{string.Join(Environment.NewLine, classes.Select(x => $"{x.Class} {x.Confidence * 100:F5}%"))}");
 
                 clip.Classifications = classes.Select(c => new Classification
@@ -255,6 +304,29 @@ public sealed class ImageAnalysisBackgroundService : IScopedBackgroundService<Im
             }
         }
     }
+
+    // the crop the classifier is most confident about, or no image if there are no crops that could be classified
+    private async Task<(byte[]? Image, (string Class, float Confidence)[] Classes)> ClassifyCropsAsync(byte[][] crops)
+    {
+        (byte[]? Image, (string Class, float Confidence)[] Classes) best = (null, Array.Empty<(string, float)>());
+        foreach (var crop in crops)
+        {
+            try
+            {
+                var classes = await _classificationService.ClassifyAsync(crop);
+                if (classes.Length > 0 && (best.Image is null || classes[0].Confidence > best.Classes[0].Confidence))
+                {
+                    best = (crop, classes);
+                }
+            }
+            catch (Exception ex)
+            {
+                _logger.LogError(ex, "Error classifying crop.");
+            }
+        }
+
+        return best;
+    }
 }
 
 public sealed class ScopedBackgroundService<T> : BackgroundService where T : IScopedBackgroundService<T>
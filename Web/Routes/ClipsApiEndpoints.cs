@@ -1,4 +1,5 @@
-﻿using Microsoft.AspNetCore.Mvc;
+﻿using System.Net.Http.Headers;
+using Microsoft.AspNetCore.Mvc;
 using Microsoft.AspNetCore.SignalR;
 using Microsoft.EntityFrameworkCore;
 using Web.Entities;
@@ -18,27 +19,74 @@ public static class ClipsApiEndpoints
             NotificationsClient client,
             ImageAnalysisChannel channel) =>
         {
-            var clip = new Clip
+            var fileId = await fileService.StoreFileAsync(data.Data);
+            await AddClipAsync(fileId, data.DateRecorded, data.Detections, Array.Empty<CropInfoData>(), db, hub, client, channel);
+        });
+
+        // Resumable upload, the clip is sent in chunks with a Content-Range header and any chunk can be retried from
+        // the offset the server has received so far. The detections are sent separately once the upload is complete.
+        group.MapPost("uploads", (FileService fileService) =>
+        {
+            var id = fileService.CreateUpload();
+            return Results.Json(new UploadInfo { Id = id, Offset = 0 }, JsonOptions.Default);
+        });
+
+        group.MapGet("uploads/{id:guid}", (Guid id, FileService fileService) =>
+        {
+            var offset = fileService.GetUploadLength(id);
+            if (offset is null)
+            {
+                return Results.NotFound();
+            }
+
+            return Results.Json(new UploadInfo { Id = id, Offset = offset.Value }, JsonOptions.Default);
+        });
+
+        group.MapPut("uploads/{id:guid}", async (Guid id, HttpRequest request, FileService fileService, CancellationToken cancellation) =>
+        {
+            var offset = fileService.GetUploadLength(id);
+            if (offset is null)
+            {
+                return Results.NotFound();
+            }
+
+            if (!ContentRangeHeaderValue.TryParse(request.Headers.ContentRange, out var range) || range.From is null)
+            {
+                return Results.BadRequest("Expected a Content-Range header");
+            }
+
+            if (range.From != offset)
+            {
+                return Results.Json(new UploadInfo { Id = id, Offset = offset.Value }, JsonOptions.Default, statusCode: StatusCodes.Status409Conflict);
+            }
+
+            var length = await fileService.AppendToUploadAsync(id, request.Body, cancellation);
+            return Results.Json(new UploadInfo { Id = id, Offset = length }, JsonOptions.Default);
+        });
+
+        group.MapDelete("uploads/{id:guid}", (Guid id, FileService fileService) =>
+        {
+            fileService.DeleteUpload(id);
+            return Results.NoContent();
+        });
+
+        group.MapPost("uploads/{id:guid}/complete", async (
+            Guid id,
+            ClipUploadInfo data,
+            AppDbContext db,
+            IHubContext<ClipHub, IClipHub> hub,
+            FileService fileService,
+            NotificationsClient client,
+            ImageAnalysisChannel channel) =>
+        {
+            if (fileService.GetUploadLength(id) is null)
             {
-                Id = Guid.NewGuid(),
-                FileId = await fileService.StoreFileAsync(data.Data),
-                Name = Guid.NewGuid().ToString(),
-                DateRecorded = data.DateRecorded,
-                CreatedAt = DateTimeOffset.UtcNow,
-                Detections = data.Detections.Select(d => new Detection
-                {
-                    Timestamp = TimeSpan.FromMilliseconds(d.Timestamp),
-                    BoundingBox = new(d.BoundingBox[0], d.BoundingBox[1], d.BoundingBox[2], d.BoundingBox[3]),
-                }).ToArray()
-            };
-
-            db.Add(clip);
-            await db.SaveChangesAsync();
-
-            var analysisTask = channel.WriteAsync(clip.Id);
-            var notifyClientTask = hub.Clients.All.NewClipAdded(clip.Id);
-            var pushNotificationTask = client.NotifyAsync(new Notification("New motion detected", $"New motion was detected at {clip.DateRecorded.ToLocalTime()}."));
-            await Task.WhenAll(notifyClientTask, pushNotificationTask);
+                return Results.NotFound();
+            }
+
+            var fileId = fileService.CompleteUpload(id);
+            await AddClipAsync(fileId, data.DateRecorded, data.Detections, data.Crops, db, hub, client, channel);
+            return Results.Ok();
         });
 
         group.MapDelete("", (Guid id, AppDbContext db, CancellationToken cancellation) =>
@@ -125,4 +173,37 @@ public static class ClipsApiEndpoints
 
         return group;
     }
+
+    private static async Task AddClipAsync(
+        Guid fileId,
+        DateTime dateRecorded,
+        DetectionInfoData[] detections,
+        CropInfoData[] crops,
+        AppDbContext db,
+        IHubContext<ClipHub, IClipHub> hub,
+        NotificationsClient client,
+        ImageAnalysisChannel channel)
+    {
+        var clip = new Clip
+        {
+            Id = Guid.NewGuid(),
+            FileId = fileId,
+            Name = Guid.NewGuid().ToString(),
+            DateRecorded = dateRecorded,
+            CreatedAt = DateTimeOffset.UtcNow,
+            Detections = detections.Select(d => new Detection
+            {
+                Timestamp = TimeSpan.FromMilliseconds(d.Timestamp),
+                BoundingBox = new(d.BoundingBox[0], d.BoundingBox[1], d.BoundingBox[2], d.BoundingBox[3]),
+            }).ToArray()
+        };
+
+        db.Add(clip);
+        await db.SaveChangesAsync();
+
+        var analysisTask = channel.WriteAsync(clip.Id, crops.Select(c => c.Image).Where(i => i.Length > 0).ToArray());
+        var notifyClientTask = hub.Clients.All.NewClipAdded(clip.Id);
+        var pushNotificationTask = client.NotifyAsync(new Notification("New motion detected", $"New motion was detected at {clip.DateRecorded.ToLocalTime()}."));
+        await Task.WhenAll(notifyClientTask, pushNotificationTask);
+    }
 }